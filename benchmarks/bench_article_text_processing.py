@@ -0,0 +1,101 @@
+"""
+Micro-benchmarks of ArticleTextProcessing on inputs of growing size.
+
+Every function is timed at several input scales and its growth exponent is estimated from the smallest and
+largest scale (about 1 for linear code, 2 for quadratic). The run fails if a function grows faster than
+--max-exponent, so that a quadratic regression is caught even on a fast machine.
+
+Usage:
+    python -m benchmarks.bench_article_text_processing [--scales 1 2 4 8] [--repeat 5] [--max-exponent 1.3]
+"""
+import math
+import random
+import sys
+import timeit
+from argparse import ArgumentParser
+
+from src.utils.ArticleTextProcessing import ArticleTextProcessing
+
+WORDS = ['knowledge', 'curation', 'the', 'of', 'model', 'search', 'engine', 'article', 'section', 'concept',
+         'information', 'retrieval', 'language', 'data', 'and', 'in', 'with', 'summary', 'outline', 'source']
+
+
+def make_sentence(rng: random.Random, citations: bool = True) -> str:
+    sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))).capitalize()
+    if citations:
+        sentence += ''.join(f'[{rng.randint(1, 50)}]' for _ in range(rng.randint(0, 2)))
+    return sentence + '.'
+
+
+def make_snippet_dump(scale: int, rng: random.Random) -> str:
+    """Numbered snippets, as ConceptGenerator used to feed limit_word_count_preserve_newline: 500 lines per scale."""
+    return '\n'.join(f'{i + 1}. ' + ' '.join(make_sentence(rng, citations=False) for _ in range(3))
+                     for i in range(500 * scale))
+
+
+def make_article(scale: int, rng: random.Random) -> str:
+    """A cited article with nested headings: 20 sections per scale."""
+    lines = []
+    for i in range(20 * scale):
+        lines.append(f'# Section {i}')
+        for j in range(3):
+            lines.append(f'## Subsection {i}.{j}')
+            lines.append(' '.join(make_sentence(rng) for _ in range(5)))
+            lines.append('')
+    return '\n'.join(lines)
+
+
+def cases(scale: int):
+    """(name, callable) of every benchmarked call at this scale, on inputs built once up front."""
+    rng = random.Random(scale)
+    dump = make_snippet_dump(scale, rng)
+    article = make_article(scale, rng)
+    citation_map = {i: 51 - i for i in range(1, 51)}
+    word_limit = len(dump.split()) // 2
+    return [
+        ('limit_word_count_preserve_newline',
+         lambda: ArticleTextProcessing.limit_word_count_preserve_newline(dump, word_limit)),
+        ('remove_citations', lambda: ArticleTextProcessing.remove_citations(article)),
+        ('clean_up_section', lambda: ArticleTextProcessing.clean_up_section(article)),
+        ('parse_article_into_dict', lambda: ArticleTextProcessing.parse_article_into_dict(article)),
+        ('update_citation_index', lambda: ArticleTextProcessing.update_citation_index(article, citation_map)),
+    ]
+
+
+def best_time(fn, repeat: int) -> float:
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def main(args) -> int:
+    scales = sorted(args.scales)
+    timings = {}
+    for scale in scales:
+        for name, fn in cases(scale):
+            timings.setdefault(name, []).append(best_time(fn, args.repeat))
+
+    header = f"{'function':<36}" + ''.join(f"{'x' + str(scale):>10}" for scale in scales) + f"{'exponent':>10}"
+    print(header)
+    print('-' * len(header))
+    failed = []
+    for name, times in timings.items():
+        exponent = math.log(times[-1] / max(times[0], 1e-9)) / math.log(scales[-1] / scales[0]) \
+            if len(scales) > 1 else float('nan')
+        print(f'{name:<36}' + ''.join(f'{t * 1000:>8.2f}ms' for t in times) + f'{exponent:>10.2f}')
+        if exponent > args.max_exponent:
+            failed.append(name)
+
+    if failed:
+        print(f"Growing faster than n^{args.max_exponent}: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='Input sizes, as multiples of the base input.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timings per call; the best one is kept.')
+    parser.add_argument('--max-exponent', type=float, default=1.3,
+                        help='Fail if a function grows faster than input size to this power.')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+import os
+from argparse import ArgumentParser
+from typing import Dict, List
+
+from sentence_transformers import SentenceTransformer
+
+from src.tools.lm import OpenAIModel_dashscope
+from src.tools.rm import GoogleSearchAli
+from src.tools.mindmap import ENCODER_PATH
+from src.actions.pipeline import PipelineRunner
+from src.utils.ConcurrencyBudget import ConcurrencyBudget
+from src.utils.UsageTracker import usage_tracker
+
+
+def load_topics(path: str) -> List[Dict]:
+    """Read a JSONL file with one {"topic": ...} object per line; blank lines are skipped."""
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def save_result(outputdir: str, file_name: str, result: Dict):
+    for sub_dir in ('map', 'outline', 'article'):
+        os.makedirs(f'{outputdir}/{sub_dir}', exist_ok=True)
+
+    mind_map = result['mind_map']
+    mind_map.save_map(mind_map.root, f'{outputdir}/map/{file_name}')
+
+    with open(f'{outputdir}/outline/{file_name}', 'w', encoding='utf-8') as file:
+        file.write(result['outline'])
+
+    with open(f'{outputdir}/article/{file_name}', 'w', encoding='utf-8') as file:
+        file.write(result['article'].to_string())
+
+
+async def run_batch(pipeline: PipelineRunner, records: List[Dict], args) -> List[Dict]:
+    """
+    Run the pipeline for every topic on one event loop, at most args.concurrency topics at a time. All topics
+    share one ConcurrencyBudget, so the LM and search limits hold for the whole batch.
+    """
+    budget = ConcurrencyBudget(llm=args.llmconcurrency, search=args.threadnum)
+    topic_limit = asyncio.Semaphore(args.concurrency)
+
+    async def run_topic(record):
+        topic = record['topic']
+        file_name = topic.replace(' ', '_')
+        if args.skipexisting and os.path.exists(f'{args.outputdir}/article/{file_name}'):
+            return {'topic': topic, 'status': 'skipped'}
+        async with topic_limit:
+            print(f'Start: {topic}')
+            try:
+                result = await pipeline.arun(topic, budget, resume=args.resume)
+                await asyncio.to_thread(save_result, args.outputdir, file_name, result)
+            except Exception as e:
+                logging.error(f'Error occurs when processing topic {topic}: {e}')
+                return {'topic': topic, 'status': 'error', 'error': repr(e)}
+        print(f'Done: {topic}')
+        return {'topic': topic, 'status': 'ok'}
+
+    try:
+        return await asyncio.gather(*(run_topic(record) for record in records))
+    finally:
+        budget.shutdown()
+        if hasattr(pipeline.lm, 'aclose'):
+            await pipeline.lm.aclose()
+
+
+def main(args):
+    kwargs = {
+        'api_key': os.getenv("OPENAI_API_KEY"),
+        'temperature': 1.0,
+        'top_p': 0.9,
+    }
+    if args.prices:
+        usage_tracker.load_prices(args.prices)
+    # One retriever, LM and encoder serve all topics, so they share the page / search / completion caches,
+    # the connection pools and the model's rate limit.
+    rm = GoogleSearchAli(k=args.retrievernum,
+                         page_cache_dir=os.path.join(args.cachedir, 'pages') if args.cachedir else None,
+                         search_cache_dir=os.path.join(args.cachedir, 'search') if args.cachedir else None)
+
+    lm = OpenAIModel_dashscope(model=args.llm, max_tokens=2000,
+                               cache_dir=os.path.join(args.cachedir, 'llm') if args.cachedir else None,
+                               cache_sampled=args.cachesampled, max_concurrency=args.llmconcurrency,
+                               rpm=args.rpm, tpm=args.tpm, **kwargs)
+
+    pipeline = PipelineRunner(
+        retriever=rm,
+        lm=lm,
+        depth=args.depth,
+        retrieve_top_k=3,
+        mind_map_kwargs={
+            'encoder': SentenceTransformer(ENCODER_PATH),
+            'encoder_name': ENCODER_PATH,
+            'embedding_cache_dir': os.path.join(args.cachedir, 'embeddings') if args.cachedir else None,
+        },
+        checkpoint_dir=args.checkpointdir or None,
+    )
+
+    records = load_topics(args.input)
+    statuses = asyncio.run(run_batch(pipeline, records, args))
+
+    os.makedirs(args.outputdir, exist_ok=True)
+    with open(f'{args.outputdir}/batch_status.jsonl', 'w', encoding='utf-8') as f:
+        for status in statuses:
+            f.write(json.dumps(status, ensure_ascii=False) + '\n')
+    failed = sum(status['status'] == 'error' for status in statuses)
+    print(f'{len(statuses) - failed}/{len(statuses)} topics finished')
+    print(usage_tracker.report())
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+
+    parser.add_argument('--input', type=str, required=True,
+                        help='JSONL file with one {"topic": ...} object per line.')
+    parser.add_argument('--outputdir', type=str, default='./results',
+                        help='Directory to store the outputs.')
+    parser.add_argument('--cachedir', type=str, default='./cache',
+                        help='Directory to store caches shared across runs. Pass an empty string to disable caching.')
+    parser.add_argument('--cachesampled', action='store_true',
+                        help='Also cache sampled (temperature > 0) LM answers, so later runs replay them. Only '
+                             'answers of runs with this flag are cached.')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Maximum number of topics processed at the same time.')
+    parser.add_argument('--skipexisting', action='store_true',
+                        help='Skip topics whose article already exists in the output directory.')
+    parser.add_argument('--checkpointdir', type=str, default='./checkpoints',
+                        help='Directory to checkpoint the progress of each topic in. Pass an empty string to disable.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue unfinished topics from their checkpoints instead of starting over.')
+    parser.add_argument('--threadnum', type=int, default=5,
+                        help='Maximum number of concurrent searches across all topics.')
+    parser.add_argument('--llmconcurrency', type=int, default=8,
+                        help='Maximum number of concurrent LM calls across all topics.')
+    parser.add_argument('--rpm', type=float, default=None,
+                        help='Requests per minute allowed for the LM, across all topics.')
+    parser.add_argument('--tpm', type=float, default=None,
+                        help='Tokens per minute allowed for the LM, across all topics.')
+    parser.add_argument('--retriever', type=str, choices=['google'], default='google',
+                        help='The search engine API to use for retrieving information.')
+    parser.add_argument('--retrievernum', type=int, default=5,
+                        help='The search engine API to use for retrieving information.')
+    parser.add_argument('--prices', type=str, default=None,
+                        help='JSON file mapping model names to [prompt, completion] prices per 1000 tokens, for the '
+                             'cost in the usage report. Known models default to their USD list prices.')
+    parser.add_argument('--llm', type=str, required=True,
+                        help='The language model API to use for generating content.')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='The depth of knowledge seeking.')
+
+    main(parser.parse_args())
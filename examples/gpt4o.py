@@ -3,11 +3,8 @@ import sys
 from argparse import ArgumentParser
 from src.tools.lm import OpenAIModel_dashscope
 from src.tools.rm import GoogleSearchAli
-from src.tools.mindmap import MindMap
-from src.actions.outline_generation import OutlineGenerationModule
-from src.dataclass.Article import Article
-from src.actions.article_generation import ArticleGenerationModule
-from src.actions.article_polish import ArticlePolishingModule
+from src.actions.pipeline import PipelineRunner
+from src.utils.UsageTracker import usage_tracker
 
 def main(args):
     kwargs = {
@@ -15,32 +12,32 @@ def main(args):
         'temperature': 1.0,
         'top_p': 0.9,
     }
+    if args.prices:
+        usage_tracker.load_prices(args.prices)
     if args.retriever == 'google':
-        rm = GoogleSearchAli(k=args.retrievernum)
+        rm = GoogleSearchAli(k=args.retrievernum,
+                             page_cache_dir=os.path.join(args.cachedir, 'pages') if args.cachedir else None,
+                             search_cache_dir=os.path.join(args.cachedir, 'search') if args.cachedir else None)
 
-    lm = OpenAIModel_dashscope(model=args.llm, max_tokens=2000, **kwargs)
+    # Sampled completions are only cached on request; otherwise every run samples afresh. A resumed run does
+    # not need them: what the interrupted run finished is restored from its checkpoints.
+    lm = OpenAIModel_dashscope(model=args.llm, max_tokens=2000,
+                               cache_dir=os.path.join(args.cachedir, 'llm') if args.cachedir else None,
+                               cache_sampled=args.cachesampled, **kwargs)
 
     topic = input('Topic: ')
     file_name = topic.replace(' ', '_')
-    mind_map = MindMap(
+    pipeline = PipelineRunner(
         retriever=rm,
-        gen_concept_lm=lm,
-        depth = args.depth
+        lm=lm,
+        depth=args.depth,
+        retrieve_top_k=3,
+        mind_map_kwargs={'embedding_cache_dir': os.path.join(args.cachedir, 'embeddings') if args.cachedir else None},
+        budget_limits={'llm': args.llmconcurrency, 'search': args.threadnum},
+        checkpoint_dir=args.checkpointdir or None,
     )
-
-    generator = mind_map.build_map(topic)   
-    for layer in generator:
-        print(layer)
-    mind_map.prepare_table_for_retrieval()
-
-    ogm = OutlineGenerationModule(lm)
-    outline = ogm.generate_outline(topic= topic, mindmap = mind_map)
-
-    article_with_outline = Article.from_outline_str(topic=topic, outline_str=outline)
-    ag = ArticleGenerationModule(retriever = rm, article_gen_lm = lm, retrieve_top_k = 3, max_thread_num = 10)
-    article = ag.generate_article(topic = topic, mindmap = mind_map, article_with_outline = article_with_outline)
-    ap = ArticlePolishingModule(article_gen_lm = lm, article_polish_lm = lm)
-    article = ap.polish_article(topic = topic, draft_article = article)
+    result = pipeline.run(topic, resume=args.resume)
+    mind_map, outline, article = result['mind_map'], result['outline'], result['article']
 
     if not os.path.exists(args.outputdir):
         os.makedirs(args.outputdir)
@@ -63,6 +60,9 @@ def main(args):
     with open(path, 'w', encoding='utf-8') as file:
         file.write(article.to_string())
 
+    print(f'Deduplication: {mind_map.get_dedup_stats()}')
+    print(usage_tracker.report())
+
 
     
 
@@ -71,15 +71,29 @@ if __name__ == '__main__':
 
     parser.add_argument('--outputdir', type=str, default='./results',
                         help='Directory to store the outputs.')
+    parser.add_argument('--cachedir', type=str, default='./cache',
+                        help='Directory to store caches shared across runs. Pass an empty string to disable caching.')
     parser.add_argument('--threadnum', type=int, default=3,
                         help='Maximum number of threads to use. The information seeking part and the article generation'
                              'part can speed up by using multiple threads. Consider reducing it if keep getting '
                              '"Exceed rate limit" error when calling LM API.')
+    parser.add_argument('--cachesampled', action='store_true',
+                        help='Also cache sampled (temperature > 0) LM answers, so later runs replay them. Only '
+                             'answers of runs with this flag are cached.')
+    parser.add_argument('--checkpointdir', type=str, default='./checkpoints',
+                        help='Directory to checkpoint the progress of each topic in. Pass an empty string to disable.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue a topic from its checkpoints instead of starting over.')
+    parser.add_argument('--llmconcurrency', type=int, default=8,
+                        help='Maximum number of concurrent LM calls across the whole pipeline.')
     parser.add_argument('--retriever', type=str,
                         help='The search engine API to use for retrieving information.')
     parser.add_argument('--retrievernum', type=int, default=5,
                         help='The search engine API to use for retrieving information.')
        
+    parser.add_argument('--prices', type=str, default=None,
+                        help='JSON file mapping model names to [prompt, completion] prices per 1000 tokens, for the '
+                             'cost in the usage report. Known models default to their USD list prices.')
     parser.add_argument('--llm', type=str,
                         help='The language model API to use for generating content.')
     parser.add_argument('--depth', type=int, default=2,
@@ -1,3 +1,4 @@
 from .article_generation import *
 from .article_polish import *
 from .outline_generation import *
+from .pipeline import *
@@ -1,13 +1,19 @@
+import asyncio
 import concurrent.futures
 import copy
 import logging
+import queue
 from concurrent.futures import as_completed
-from typing import List, Union
+from typing import Dict, Iterator, List, Optional, Union
 import random
 import dspy
 import sys
+from dspy.signatures.signature import signature_to_template
 
 from src.utils.ArticleTextProcessing import ArticleTextProcessing
+from src.utils.ConcurrencyBudget import ConcurrencyBudget
+from src.utils.ContextPacker import ContextPacker, context_budget
+from src.utils.UsageTracker import usage_stage
 
 # This code is originally sourced from Repository STORM
 # URL: [https://github.com/stanford-oval/storm]
@@ -59,14 +65,8 @@ class ArticleGenerationModule():
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_thread_num) as executor:
             future_to_sec_title = {}
             for section_title in sections_to_write:
-                section_query = article_with_outline.get_outline_as_list(
-                    root_section_name=section_title, add_hashtags=False
-                )
-                queries_with_hashtags = article_with_outline.get_outline_as_list(
-                    root_section_name=section_title, add_hashtags=True
-                )
-                section_outline = "\n".join(queries_with_hashtags)
-
+                section_query, section_outline = self._get_section_query_and_outline(article_with_outline,
+                                                                                     section_title)
                 future_to_sec_title[
                     executor.submit(self.generate_section, 
                                     topic, section_title, mindmap, section_query,section_outline)
@@ -75,6 +75,103 @@ class ArticleGenerationModule():
             for future in concurrent.futures.as_completed(future_to_sec_title):
                 section_output_dict_collection.append(future.result())
 
+        return self._assemble_article(topic, article_with_outline, section_output_dict_collection)
+
+    async def agenerate_article(self,
+                                topic: str,
+                                mindmap,
+                                article_with_outline,
+                                budget: Optional[ConcurrencyBudget] = None,
+                                ):
+        """
+        Async variant of generate_article. All sections are written concurrently; the number of LM calls in
+        flight is bounded by budget (by default max_thread_num).
+        """
+        own_budget = budget is None
+        budget = budget or ConcurrencyBudget(llm=self.max_thread_num)
+        try:
+            return await self._agenerate_article(topic, mindmap, article_with_outline, budget)
+        finally:
+            if own_budget:
+                budget.shutdown()
+
+    async def _agenerate_article(self, topic: str, mindmap, article_with_outline, budget: ConcurrencyBudget):
+        await budget.run('encode', mindmap.prepare_table_for_retrieval)
+
+        async def write_section(section_title):
+            section_query, section_outline = self._get_section_query_and_outline(article_with_outline, section_title)
+            collected_info = await budget.run('encode', mindmap.retrieve_information, queries=section_query,
+                                              search_top_k=self.retrieve_top_k)
+            output = await self.section_gen.aforward(topic=topic, outline=section_outline, section=section_title,
+                                                     collected_info=collected_info, budget=budget)
+            return {"section_name": section_title, "section_content": output.section, "collected_info": collected_info}
+
+        section_output_dict_collection = await asyncio.gather(
+            *(write_section(section_title) for section_title in article_with_outline.get_first_level_section_names()))
+        return self._assemble_article(topic, article_with_outline, section_output_dict_collection)
+
+    def generate_article_stream(self,
+                                topic: str,
+                                mindmap,
+                                article_with_outline,
+                                ) -> Iterator[Dict]:
+        """
+        Streaming variant of generate_article. Sections are written concurrently and their text is emitted
+        as it arrives from the LM, as a sequence of events:
+            {'type': 'section_delta', 'section_name': ..., 'text': ...}   a new chunk of a section's raw text
+            {'type': 'section_done', 'section_name': ..., 'section_content': ...}   the cleaned-up section
+            {'type': 'article', 'article': ...}   the finished article, always the last event
+        """
+        mindmap.prepare_table_for_retrieval()
+
+        events = queue.Queue()
+        done = object()
+
+        def write_section(section_title):
+            section_query, section_outline = self._get_section_query_and_outline(article_with_outline, section_title)
+            collected_info = mindmap.retrieve_information(queries=section_query, search_top_k=self.retrieve_top_k)
+            chunks = []
+            for chunk in self.section_gen.stream(topic=topic, outline=section_outline, section=section_title,
+                                                 collected_info=collected_info):
+                chunks.append(chunk)
+                events.put({'type': 'section_delta', 'section_name': section_title, 'text': chunk})
+            section = self.section_gen.postprocess(''.join(chunks))
+            events.put({'type': 'section_done', 'section_name': section_title, 'section_content': section})
+            return {"section_name": section_title, "section_content": section, "collected_info": collected_info}
+
+        section_output_dict_collection = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_thread_num) as executor:
+            futures = [executor.submit(write_section, section_title)
+                       for section_title in article_with_outline.get_first_level_section_names()]
+            for future in futures:
+                future.add_done_callback(lambda _: events.put(done))
+
+            remaining = len(futures)
+            while remaining:
+                event = events.get()
+                if event is done:
+                    remaining -= 1
+                else:
+                    yield event
+
+            for future in futures:
+                section_output_dict_collection.append(future.result())
+
+        yield {'type': 'article',
+               'article': self._assemble_article(topic, article_with_outline, section_output_dict_collection)}
+
+    @staticmethod
+    def _get_section_query_and_outline(article_with_outline, section_title):
+        section_query = article_with_outline.get_outline_as_list(
+            root_section_name=section_title, add_hashtags=False
+        )
+        queries_with_hashtags = article_with_outline.get_outline_as_list(
+            root_section_name=section_title, add_hashtags=True
+        )
+        return section_query, "\n".join(queries_with_hashtags)
+
+    @staticmethod
+    def _assemble_article(topic, article_with_outline, section_output_dict_collection):
         article = copy.deepcopy(article_with_outline)
         for section_output_dict in section_output_dict_collection:
             article.update_section(parent_section_name=topic,
@@ -88,25 +185,84 @@ class ArticleGenerationModule():
 
 class ConvToSection(dspy.Module):
     """Use the information collected from the information-seeking conversation to write a section."""
-    def __init__(self, engine: Union[dspy.dsp.LM, dspy.dsp.HFModel]):
+    # Share of the engine's context window given to the collected information by default.
+    CONTEXT_SHARE = 1 / 16
+
+    def __init__(self, engine: Union[dspy.dsp.LM, dspy.dsp.HFModel], context_tokens: Optional[int] = None):
+        """
+        Args:
+            context_tokens: Token budget of the collected information in the prompt, counted with the
+                tokenizer of the engine's model. CONTEXT_SHARE of the engine's context window if None.
+        """
         super().__init__()
         self.write_section = dspy.Predict(WriteSection)
         self.engine = engine
+        if context_tokens is None:
+            context_tokens = context_budget(engine, self.CONTEXT_SHARE)
+        self.packer = ContextPacker(context_tokens, model=getattr(engine, 'model', None), stage='section')
 
-    def forward(self, topic: str, outline:str, section: str, collected_info: List):
+    def format_info(self, collected_info: List, query: str = '') -> str:
+        """
+        The collected information as numbered sources, keeping the snippets most relevant to query that fit
+        the token budget. A source keeps its number, which its citations refer to, even if others are left out.
+        """
+        snippets = [snippet for info in collected_info for snippet in info['snippets']]
+        sources = [idx for idx, info in enumerate(collected_info) for _ in info['snippets']]
+        selected, _, _ = self.packer.pack(snippets, query=query, groups=sources, group_overhead=3)
+
+        source_snippets = {}
+        for i in selected:
+            source_snippets.setdefault(sources[i], []).append(snippets[i])
         all_info = ''
-        for idx, info in enumerate(collected_info):
-            all_info += f'[{idx + 1}]\n' + '\n'.join(info['snippets'])
+        for idx, source in source_snippets.items():
+            all_info += f'[{idx + 1}]\n' + '\n'.join(source)
             all_info += '\n\n'
 
-        all_info = ArticleTextProcessing.limit_word_count_preserve_newline(all_info, 1500)
+        return all_info.strip()
+
+    @staticmethod
+    def postprocess(section: str) -> str:
+        section = ArticleTextProcessing.clean_up_section(section)
+        return section.replace('\[','[').replace('\]',']')
 
-        with dspy.settings.context(lm=self.engine):
-            section = ArticleTextProcessing.clean_up_section(
-                self.write_section(topic=topic, info=info, section=section).output)
+    def forward(self, topic: str, outline:str, section: str, collected_info: List):
+        all_info = self.format_info(collected_info, query=f'{section}\n{outline}')
+
+        with dspy.settings.context(lm=self.engine), usage_stage('section'):
+            section = self.write_section(topic=topic, info=all_info, section=section).output
          
-        section = section.replace('\[','[').replace('\]',']')
-        return dspy.Prediction(section=section)
+        return dspy.Prediction(section=self.postprocess(section))
+
+    async def aforward(self, topic: str, outline: str, section: str, collected_info: List,
+                       budget: ConcurrencyBudget):
+        """Async variant of forward, calling the LM natively when it has acall."""
+        if not hasattr(self.engine, 'acall'):
+            return await budget.run('llm', self.forward, topic=topic, outline=outline, section=section,
+                                    collected_info=collected_info)
+        prompt = self.render_prompt(topic, section, collected_info, outline)
+        with usage_stage('section'):
+            async with budget.limit('llm'):
+                section = (await self.engine.acall(prompt))[0]
+        return dspy.Prediction(section=self.postprocess(section))
+
+    def render_prompt(self, topic: str, section: str, collected_info: List, outline: str = '') -> str:
+        """The WriteSection prompt that forward sends, for calling the LM directly."""
+        template = signature_to_template(WriteSection)
+        info = self.format_info(collected_info, query=f'{section}\n{outline}')
+        return template(dspy.dsp.Example(demos=[], topic=topic, info=info, section=section))
+
+    def stream(self, topic: str, outline: str, section: str, collected_info: List) -> Iterator[str]:
+        """
+        Write the section like forward, but yield the raw LM output chunk by chunk. Pass the joined chunks
+        through postprocess to get what forward would return.
+        """
+        prompt = self.render_prompt(topic, section, collected_info, outline)
+
+        with usage_stage('section'):
+            if hasattr(self.engine, 'stream'):
+                yield from self.engine.stream(prompt)
+            else:
+                yield self.engine(prompt)[0]
 
 class WriteSection(dspy.Signature):
     """Write a Wikipedia section based on the collected information.
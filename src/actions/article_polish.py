@@ -2,6 +2,7 @@ import copy
 from typing import Union
 import dspy
 from src.utils.ArticleTextProcessing import ArticleTextProcessing
+from src.utils.UsageTracker import usage_stage
 
 # This code is originally sourced from Repository STORM
 # URL: [https://github.com/stanford-oval/storm]
@@ -66,7 +67,7 @@ class PolishPageModule(dspy.Module):
 
     def forward(self, topic: str, draft_page: str, polish_whole_page: bool = True):
 
-        with dspy.settings.context(lm=self.polish_engine):
+        with dspy.settings.context(lm=self.polish_engine), usage_stage('polish'):
             page = self.polish_page(article=draft_page).page
 
         return dspy.Prediction(page=page)
@@ -1,6 +1,7 @@
 import dspy
 from src.tools.mindmap import MindMap
 from src.utils.ArticleTextProcessing import ArticleTextProcessing
+from src.utils.UsageTracker import usage_stage
 from typing import Union, Optional, Tuple
 
 # This code is originally sourced from Repository STORM
@@ -35,7 +36,7 @@ class WriteOutline(dspy.Module):
 
     def forward(self, topic: str, concepts: str):
         
-        with dspy.settings.context(lm=self.engine):
+        with dspy.settings.context(lm=self.engine), usage_stage('outline'):
             outline = ArticleTextProcessing.clean_up_outline(
                 self.draft_page_outline(topic=topic).outline)
             outline = ArticleTextProcessing.clean_up_outline(
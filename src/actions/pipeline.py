@@ -0,0 +1,128 @@
+import asyncio
+import os
+from typing import Dict, Optional, Union
+
+import dspy
+
+from src.actions.article_generation import ArticleGenerationModule
+from src.actions.article_polish import ArticlePolishingModule
+from src.actions.outline_generation import OutlineGenerationModule
+from src.dataclass.Article import Article
+from src.tools.mindmap import MindMap
+from src.utils.Checkpoint import Checkpoint
+from src.utils.ConcurrencyBudget import ConcurrencyBudget
+
+
+class PipelineRunner():
+    """
+    Runs the whole pipeline for a topic: build the mind map, write the outline, generate and polish the article.
+
+    arun is asyncio-native: the searches and LM calls of different mind map branches and of different sections
+    overlap, bounded by one ConcurrencyBudget. Several topics can be run concurrently on the same loop with the
+    same budget, which then bounds them all together. run is a blocking wrapper around arun.
+
+    With a checkpoint_dir, every mind map node and the result of every stage (map, outline, draft and polished
+    article) is persisted under checkpoint_dir/<topic> as soon as it is done. A run with resume=True reloads
+    them and only does the remaining work.
+    """
+
+    def __init__(self,
+                 retriever,
+                 lm: Union[dspy.dsp.LM, dspy.dsp.HFModel],
+                 depth: int = 2,
+                 retrieve_top_k: int = 3,
+                 mind_map_kwargs: Optional[Dict] = None,
+                 budget_limits: Optional[Dict[str, int]] = None,
+                 checkpoint_dir: Optional[str] = None,
+                 ):
+        """
+        Args:
+            retriever: Search retriever, used natively if it has aforward.
+            lm: LM used by every stage, called natively by the section writer if it has acall.
+            depth: Depth of the mind map.
+            retrieve_top_k: Number of snippets retrieved from the mind map per section query.
+            mind_map_kwargs: Extra MindMap arguments, e.g. {'embedding_cache_dir': ...}.
+            budget_limits: Concurrency limits of the budget created by run, e.g. {'llm': 8, 'search': 5}.
+            checkpoint_dir: If set, progress is checkpointed there, one sub-directory per topic.
+        """
+        self.retriever = retriever
+        self.lm = lm
+        self.depth = depth
+        self.retrieve_top_k = retrieve_top_k
+        self.mind_map_kwargs = mind_map_kwargs or {}
+        self.budget_limits = budget_limits or {}
+        self.checkpoint_dir = checkpoint_dir
+        self.outline_generation = OutlineGenerationModule(lm)
+        self.article_generation = ArticleGenerationModule(retriever=retriever, article_gen_lm=lm,
+                                                          retrieve_top_k=retrieve_top_k)
+        self.article_polishing = ArticlePolishingModule(article_gen_lm=lm, article_polish_lm=lm)
+
+    def create_mind_map(self, checkpoint_dir: Optional[str] = None) -> MindMap:
+        return MindMap(retriever=self.retriever, gen_concept_lm=self.lm, depth=self.depth,
+                       checkpoint_dir=checkpoint_dir, **self.mind_map_kwargs)
+
+    def get_checkpoint(self, topic: str) -> Optional[Checkpoint]:
+        if self.checkpoint_dir is None:
+            return None
+        return Checkpoint(os.path.join(self.checkpoint_dir, topic.replace(' ', '_').replace('/', '_')))
+
+    async def arun(self, topic: str, budget: Optional[ConcurrencyBudget] = None,
+                   mind_map: Optional[MindMap] = None, resume: bool = False) -> Dict:
+        """
+        Args:
+            resume: Continue from the checkpoints of a previous run of this topic instead of starting over.
+
+        Returns:
+            {'mind_map': MindMap, 'outline': str, 'article': Article}
+        """
+        own_budget = budget is None
+        budget = budget or ConcurrencyBudget(**self.budget_limits)
+        try:
+            return await self._arun(topic, budget, mind_map, resume)
+        finally:
+            if own_budget:
+                budget.shutdown()
+
+    async def _arun(self, topic: str, budget: ConcurrencyBudget, mind_map: Optional[MindMap],
+                    resume: bool) -> Dict:
+        checkpoint = self.get_checkpoint(topic)
+        resume = resume and checkpoint is not None
+        if checkpoint is not None and not resume:
+            checkpoint.clear()  # a fresh run must not leave stale stages behind for a later resume
+        mind_map = mind_map or self.create_mind_map(
+            checkpoint_dir=checkpoint.path('map_nodes') if checkpoint is not None else None)
+
+        if resume and checkpoint.has('map.npz'):
+            await budget.run('encode', mind_map.load_map, checkpoint.path('map.npz'))
+            await budget.run('encode', mind_map.prepare_table_for_retrieval)
+        else:
+            await mind_map.abuild_map(topic, budget, resume=resume)
+            await budget.run('encode', mind_map.prepare_table_for_retrieval)
+            if checkpoint is not None:
+                await asyncio.to_thread(mind_map.save_map, mind_map.root, checkpoint.path('map.npz'), compact=True)
+
+        async def stage(name, compute):
+            """The result of stage `name`: the checkpointed one when resuming, else compute it and checkpoint it."""
+            if resume and checkpoint.has(name):
+                return await asyncio.to_thread(checkpoint.load_pickle, name)
+            result = await compute()
+            if checkpoint is not None:
+                await asyncio.to_thread(checkpoint.save_pickle, name, result)
+            return result
+
+        outline = await stage('outline.pkl', lambda: budget.run(
+            'llm', self.outline_generation.generate_outline, topic=topic, mindmap=mind_map))
+        article_with_outline = Article.from_outline_str(topic=topic, outline_str=outline)
+        article = await stage('draft.pkl', lambda: self.article_generation.agenerate_article(
+            topic, mind_map, article_with_outline, budget))
+        article = await stage('article.pkl', lambda: budget.run(
+            'llm', self.article_polishing.polish_article, topic=topic, draft_article=article))
+
+        return {'mind_map': mind_map, 'outline': outline, 'article': article}
+
+    def run(self, topic: str, mind_map: Optional[MindMap] = None, resume: bool = False) -> Dict:
+        budget = ConcurrencyBudget(**self.budget_limits)
+        try:
+            return asyncio.run(self.arun(topic, budget, mind_map, resume=resume))
+        finally:
+            budget.shutdown()
@@ -1,14 +1,140 @@
+import asyncio
+import hashlib
+import json
 import random
 import threading
 import time
 import dspy
+import httpx
 import os
-from typing import Optional, Literal, Any
+from email.utils import parsedate_to_datetime
+from typing import Optional, Literal, Any, Dict, Iterator, List, Tuple
 from dashscope import Generation
+from src.utils.DiskCache import DiskCache
+from src.utils.RateLimiter import estimate_tokens, get_rate_limiter
+from src.utils.UsageTracker import UsageTracker, current_stage, usage_tracker as default_usage_tracker
 
 # This code is originally sourced from Repository STORM
 # URL: [https://github.com/stanford-oval/storm]
 
+DASHSCOPE_CHAT_URL = 'https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions'
+SAMPLING_PARAMS = ('temperature', 'top_p', 'top_k', 'n', 'stop', 'seed', 'presence_penalty', 'frequency_penalty')
+
+
+class CompletionCache:
+    """
+    Persistent, content-addressed cache of LM completions.
+
+    The key hashes the model, prompt, max_tokens and sampling parameters, so a hit is only returned for an
+    identical request. The cache lives in a SQLite file and can be shared by threads and processes.
+    """
+
+    def __init__(self, cache_dir: str, ttl: Optional[float] = 30 * 24 * 3600, max_entries: Optional[int] = 100000):
+        self.cache = DiskCache(os.path.join(cache_dir, 'completions.sqlite'), table='completions', ttl=ttl,
+                               max_entries=max_entries)
+
+    @staticmethod
+    def make_key(model: str, prompt: str, max_tokens: Optional[int], params: Dict) -> str:
+        request = json.dumps({'model': model, 'prompt': prompt, 'max_tokens': max_tokens, 'params': params},
+                             sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        return self.cache.get(key)
+
+    def set(self, key: str, completions: List[str]):
+        self.cache.set(key, completions)
+
+
+class LMRequestError(RuntimeError):
+    """Raised when an LM request fails permanently or keeps failing after all retries."""
+
+
+_model_semaphores = {}
+_model_semaphores_lock = threading.Lock()
+
+
+def get_model_semaphore(model: str, max_concurrency: int) -> threading.BoundedSemaphore:
+    """One semaphore per model name, shared by every wrapper instance in the process."""
+    with _model_semaphores_lock:
+        if model not in _model_semaphores:
+            _model_semaphores[model] = threading.BoundedSemaphore(max_concurrency)
+        return _model_semaphores[model]
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0, retry_after: Optional[str] = None) -> float:
+    """
+    Seconds to wait before retry number `attempt` (starting at 0): the server's Retry-After if it sent one,
+    otherwise exponential backoff with full jitter.
+    """
+    if retry_after:
+        try:
+            return min(cap, max(0.0, float(retry_after)))
+        except ValueError:
+            try:
+                return min(cap, max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def create_http_client(max_connections: int, timeout: float, asynchronous: bool = False):
+    """A long-lived keep-alive client (an httpx.AsyncClient if asynchronous), speaking HTTP/2 when h2 is installed."""
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+    client_class = httpx.AsyncClient if asynchronous else httpx.Client
+    return client_class(
+        http2=http2,
+        timeout=timeout,
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+    )
+
+
+def usage_tokens(usage: Optional[Dict]) -> tuple:
+    """
+    (prompt_tokens, completion_tokens) of a usage block. The OpenAI compatible endpoint reports
+    prompt_tokens / completion_tokens while the native DashScope API reports input_tokens / output_tokens.
+    """
+    if not usage:
+        return 0, 0
+    prompt_tokens = usage.get('prompt_tokens', usage.get('input_tokens')) or 0
+    completion_tokens = usage.get('completion_tokens', usage.get('output_tokens')) or 0
+    return prompt_tokens, completion_tokens
+
+
+def reserve_rate_limit(lm, prompt: str, max_tokens: Optional[int]) -> int:
+    """Wait for the model's rate limit, if any, to allow one request of this prompt. Returns the reserved tokens."""
+    if lm.rate_limiter is None:
+        return 0
+    return lm.rate_limiter.acquire(estimate_tokens(prompt) + (max_tokens or 0))
+
+
+async def areserve_rate_limit(lm, prompt: str, max_tokens: Optional[int]) -> int:
+    if lm.rate_limiter is None:
+        return 0
+    return await lm.rate_limiter.aacquire(estimate_tokens(prompt) + (max_tokens or 0))
+
+
+def settle_rate_limit(lm, reserved: int, prompt_tokens: int, completion_tokens: int):
+    if lm.rate_limiter is not None:
+        lm.rate_limiter.settle(reserved, prompt_tokens + completion_tokens)
+
+
+def get_cache_key(lm, prompt: str, max_tokens: Optional[int], call_kwargs: Dict) -> Optional[str]:
+    """
+    The completion cache key of a request, or None if the request must not be served from the cache:
+    no cache is configured, or the request samples (temperature > 0) and lm.cache_sampled is off.
+    """
+    if lm.completion_cache is None:
+        return None
+    params = {k: v for k, v in {**lm.kwargs, **call_kwargs}.items() if k in SAMPLING_PARAMS}
+    if params.get('temperature', 0) > 0 and not lm.cache_sampled:
+        return None
+    return CompletionCache.make_key(lm.model, prompt, max_tokens, params)
+
 
 class OpenAIModel_dashscope(dspy.OpenAI):
     """A wrapper class for dspy.OpenAI."""
@@ -18,22 +144,58 @@ class OpenAIModel_dashscope(dspy.OpenAI):
             model: str = "gpt-4",
             max_tokens: int = 2000,
             api_key: Optional[str] = None,
+            cache_dir: Optional[str] = None,
+            cache_sampled: bool = False,
+            max_retries: int = 5,
+            max_concurrency: int = 8,
+            request_timeout: float = 180,
+            usage_tracker: Optional[UsageTracker] = None,
+            rpm: Optional[float] = None,
+            tpm: Optional[float] = None,
             **kwargs
     ):
+        """
+        Args:
+            cache_dir: If set, completions are cached on disk there and reused for identical requests.
+            cache_sampled: Also cache requests with temperature > 0, trading sampling diversity for replayable runs.
+            max_retries: Number of attempts before LMRequestError is raised.
+            max_concurrency: Maximum number of in-flight requests per model, shared by all instances.
+            request_timeout: Timeout of each request in seconds.
+            usage_tracker: Where every call is accounted per stage. Defaults to the process-wide tracker.
+            rpm, tpm: Requests / tokens per minute allowed for this model, shared by all instances of it in the
+                process. The first instance that sets them fixes the limits.
+        """
         super().__init__(model=model, api_key=api_key, **kwargs)
         self.model = model
+        self.completion_cache = CompletionCache(cache_dir) if cache_dir else None
+        self.cache_sampled = cache_sampled
+        self.max_retries = max_retries
+        self.usage_tracker = usage_tracker or default_usage_tracker
+        self.rate_limiter = get_rate_limiter(model, rpm=rpm, tpm=tpm)
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        self.http_client = create_http_client(max_concurrency, request_timeout)
+        self._semaphore = get_model_semaphore(model, max_concurrency)
+        # The async client and its semaphore are bound to the event loop they were created on, see acall.
+        self._async_client = None
+        self._async_semaphore = None
+        self._async_loop = None
+        self._headers = {
+            'Content-Type': 'application/json',
+            "Authorization": f"Bearer {os.getenv('DASHSCOPE_KEY')}"
+        }
         self._token_usage_lock = threading.Lock()
         self.max_tokens = max_tokens
         self.prompt_tokens = 0
         self.completion_tokens = 0
 
-    def log_usage(self, response):
-        """Log the total tokens from the OpenAI API response."""
-        usage_data = response.get('usage')
-        if usage_data:
-            with self._token_usage_lock:
-                self.prompt_tokens += usage_data.get('input_tokens', 0)
-                self.completion_tokens += usage_data.get('output_tokens', 0)
+    def log_usage(self, response) -> tuple:
+        """Log the total tokens from the API response and return them as (prompt_tokens, completion_tokens)."""
+        prompt_tokens, completion_tokens = usage_tokens(response.get('usage'))
+        with self._token_usage_lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+        return prompt_tokens, completion_tokens
 
     def get_usage_and_reset(self):
         """Get the total tokens used and reset the token usage."""
@@ -58,38 +220,191 @@ class OpenAIModel_dashscope(dspy.OpenAI):
         assert only_completed, "for now"
         assert return_sorted is False, "for now"
 
-        CALL_URL = 'https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions'
-        DASHSCOPE_KEY = os.getenv('DASHSCOPE_KEY')
-        HEADERS = {
-            'Content-Type': 'application/json',
-            "Authorization": f"Bearer {DASHSCOPE_KEY}"
-        }
+        stage, start = current_stage(), time.time()
+        cache_key = get_cache_key(self, prompt, self.max_tokens, kwargs)
+        if cache_key is not None:
+            completions = self.completion_cache.get(cache_key)
+            if completions is not None:
+                self.usage_tracker.record(self.model, cached=True, stage=stage)
+                return completions
+
+        payload = self._payload(prompt, stream=False)
+        last_error = None
+        for attempt in range(self.max_retries):
+            retry_after = None
+            try:
+                reserved = reserve_rate_limit(self, prompt, self.max_tokens)
+                with self._semaphore:
+                    ret = self.http_client.post(DASHSCOPE_CHAT_URL, json=payload, headers=self._headers)
+                completions, last_error, retry_after = self._handle_response(ret, cache_key, stage, start, attempt,
+                                                                             reserved)
+                if completions is not None:
+                    return completions
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                last_error = e
+            if attempt < self.max_retries - 1:
+                print(f"请求失败: {last_error}. 尝试重新请求...")
+                time.sleep(backoff_delay(attempt, retry_after=retry_after))
+
+        raise LMRequestError(f'Request to {self.model} failed after {self.max_retries} attempts: {last_error}') \
+            from last_error
+
+    async def acall(self, prompt: str, **kwargs) -> List[str]:
+        """
+        Async variant of __call__, sharing its cache, retry policy and usage accounting. Requests go through
+        an httpx.AsyncClient with at most max_concurrency of them in flight per instance and event loop.
+        """
+        stage, start = current_stage(), time.time()
+        cache_key = get_cache_key(self, prompt, self.max_tokens, kwargs)
+        if cache_key is not None:
+            completions = await asyncio.to_thread(self.completion_cache.get, cache_key)
+            if completions is not None:
+                self.usage_tracker.record(self.model, cached=True, stage=stage)
+                return completions
+
+        client, semaphore = self._get_async_client()
+        payload = self._payload(prompt, stream=False)
+        last_error = None
+        for attempt in range(self.max_retries):
+            retry_after = None
+            try:
+                reserved = await areserve_rate_limit(self, prompt, self.max_tokens)
+                async with semaphore:
+                    ret = await client.post(DASHSCOPE_CHAT_URL, json=payload, headers=self._headers)
+                completions, last_error, retry_after = self._handle_response(ret, cache_key, stage, start, attempt,
+                                                                             reserved)
+                if completions is not None:
+                    return completions
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                last_error = e
+            if attempt < self.max_retries - 1:
+                print(f"请求失败: {last_error}. 尝试重新请求...")
+                await asyncio.sleep(backoff_delay(attempt, retry_after=retry_after))
+
+        raise LMRequestError(f'Request to {self.model} failed after {self.max_retries} attempts: {last_error}') \
+            from last_error
+
+    def _get_async_client(self) -> Tuple[httpx.AsyncClient, asyncio.Semaphore]:
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            self._async_client = create_http_client(self.max_concurrency, self.request_timeout, asynchronous=True)
+            self._async_semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._async_loop = loop
+        return self._async_client, self._async_semaphore
 
-        kwargs = dict(
+    async def aclose(self):
+        """Close the async client of the running event loop, if any."""
+        if self._async_client is not None and self._async_loop is asyncio.get_running_loop():
+            await self._async_client.aclose()
+            self._async_client = self._async_semaphore = self._async_loop = None
+
+    def _payload(self, prompt: str, stream: bool) -> Dict:
+        payload = dict(
             model=self.model,
             messages=[{"role": "user", "content": prompt}],
             max_completion_tokens=self.max_tokens,
-            stream=False,
+            stream=stream,
         )
-        import requests
-        max_try = 3
-        for i in range(max_try):
-            try:
-                ret = requests.post(CALL_URL, json=kwargs,
-                                    headers=HEADERS, timeout=180)
-                if ret.status_code != 200:
-                    raise Exception(f"http status_code: {ret.status_code}\n{ret.content}")
-                ret_json = ret.json()
-                for output in ret_json['choices']:
-                    if output['finish_reason'] not in ['stop', 'function_call']:
-                        raise Exception(f'openai finish with error...\n{ret_json}')
-                return [ret_json['choices'][0]['message']['content']]
-            except Exception as e:
-                print(f"请求失败: {e}. 尝试重新请求...")    
-                time.sleep(1)
+        if stream:
+            # The last chunk then carries the usage of the whole request, with empty choices.
+            payload['stream_options'] = {'include_usage': True}
+        return payload
+
+    def _handle_response(self, ret: httpx.Response, cache_key: Optional[str], stage: str, start: float, attempt: int,
+                         reserved: int = 0) -> Tuple[Optional[List[str]], Optional[Exception], Optional[str]]:
+        """
+        Interpret the response of a non-streaming request.
 
+        Returns:
+            (completions, None, None) on success, otherwise (None, the error, the server's Retry-After) for a
+            failure worth retrying. Raises LMRequestError on errors that will not succeed on retry.
+        """
+        if ret.status_code == 200:
+            ret_json = ret.json()
+            prompt_tokens, completion_tokens = self.log_usage(ret_json)
+            settle_rate_limit(self, reserved, prompt_tokens, completion_tokens)
+            self.usage_tracker.record(self.model, prompt_tokens, completion_tokens,
+                                      latency=time.time() - start, retries=attempt, stage=stage)
+            if all(output['finish_reason'] in ['stop', 'function_call'] for output in ret_json['choices']):
+                completions = [ret_json['choices'][0]['message']['content']]
+                if cache_key is not None:
+                    self.completion_cache.set(cache_key, completions)
+                return completions, None, None
+            return None, LMRequestError(f'openai finish with error...\n{ret_json}'), None
+        if ret.status_code == 429 or ret.status_code >= 500:
+            return None, LMRequestError(f"http status_code: {ret.status_code}\n{ret.text}"), \
+                ret.headers.get('Retry-After')
+        # Other client errors (bad request, auth, ...) will not succeed on retry.
+        raise LMRequestError(f"http status_code: {ret.status_code}\n{ret.text}")
 
+    def stream(self, prompt: str, **kwargs) -> Iterator[str]:
+        """
+        Stream the completion of prompt, yielding text chunks as they arrive.
+
+        Failures before the first chunk are retried like __call__; a failure mid-stream raises LMRequestError.
+        """
+        stage, start = current_stage(), time.time()
+        cache_key = get_cache_key(self, prompt, self.max_tokens, kwargs)
+        if cache_key is not None:
+            completions = self.completion_cache.get(cache_key)
+            if completions is not None:
+                self.usage_tracker.record(self.model, cached=True, stage=stage)
+                yield completions[0]
+                return
+
+        payload = self._payload(prompt, stream=True)
+        last_error = None
+        for attempt in range(self.max_retries):
+            retry_after = None
+            chunks = []
+            try:
+                reserved = reserve_rate_limit(self, prompt, self.max_tokens)
+                with self._semaphore, self.http_client.stream(
+                        'POST', DASHSCOPE_CHAT_URL, json=payload, headers=self._headers) as ret:
+                    if ret.status_code == 200:
+                        finish_reason = None
+                        usage = None
+                        for line in ret.iter_lines():
+                            if not line.startswith('data:'):
+                                continue
+                            data = line[len('data:'):].strip()
+                            if data == '[DONE]':
+                                break
+                            event = json.loads(data)
+                            usage = event.get('usage') or usage
+                            if not event.get('choices'):
+                                continue
+                            choice = event['choices'][0]
+                            delta = choice.get('delta', {}).get('content')
+                            if delta:
+                                chunks.append(delta)
+                                yield delta
+                            finish_reason = choice.get('finish_reason') or finish_reason
+                        prompt_tokens, completion_tokens = self.log_usage({'usage': usage})
+                        settle_rate_limit(self, reserved, prompt_tokens, completion_tokens)
+                        self.usage_tracker.record(self.model, prompt_tokens, completion_tokens,
+                                                  latency=time.time() - start, retries=attempt, stage=stage)
+                        if finish_reason in ['stop', 'function_call']:
+                            if cache_key is not None:
+                                self.completion_cache.set(cache_key, [''.join(chunks)])
+                            return
+                        last_error = LMRequestError(f'openai finish with error... finish_reason: {finish_reason}')
+                    elif ret.status_code == 429 or ret.status_code >= 500:
+                        retry_after = ret.headers.get('Retry-After')
+                        last_error = LMRequestError(f"http status_code: {ret.status_code}\n{ret.read()}")
+                    else:
+                        raise LMRequestError(f"http status_code: {ret.status_code}\n{ret.read()}")
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                last_error = e
+            if chunks:
+                # Part of the answer has been consumed already, a retry would repeat it.
+                raise LMRequestError(f'Stream from {self.model} broke off: {last_error}') from last_error
+            if attempt < self.max_retries - 1:
+                print(f"请求失败: {last_error}. 尝试重新请求...")
+                time.sleep(backoff_delay(attempt, retry_after=retry_after))
 
+        raise LMRequestError(f'Request to {self.model} failed after {self.max_retries} attempts: {last_error}') \
+            from last_error
 
 
 class QwenModel(dspy.OpenAI):
@@ -99,22 +414,39 @@ class QwenModel(dspy.OpenAI):
             self,
             model: str = "qwen-max-allinone",
             api_key: Optional[str] = None,
+            cache_dir: Optional[str] = None,
+            cache_sampled: bool = False,
+            usage_tracker: Optional[UsageTracker] = None,
+            rpm: Optional[float] = None,
+            tpm: Optional[float] = None,
             **kwargs
     ):
+        """
+        Args:
+            cache_dir: If set, completions are cached on disk there and reused for identical requests.
+            cache_sampled: Also cache requests with temperature > 0, trading sampling diversity for replayable runs.
+            usage_tracker: Where every call is accounted per stage. Defaults to the process-wide tracker.
+            rpm, tpm: Requests / tokens per minute allowed for this model, shared by all instances of it in the
+                process. The first instance that sets them fixes the limits.
+        """
         super().__init__(model=model, api_key=api_key, **kwargs)
         self.model = model
+        self.completion_cache = CompletionCache(cache_dir) if cache_dir else None
+        self.cache_sampled = cache_sampled
+        self.usage_tracker = usage_tracker or default_usage_tracker
+        self.rate_limiter = get_rate_limiter(model, rpm=rpm, tpm=tpm)
         self.api_key = api_key
         self._token_usage_lock = threading.Lock()
         self.prompt_tokens = 0
         self.completion_tokens = 0
 
-    def log_usage(self, response):
-        """Log the total tokens from the OpenAI API response."""
-        usage_data = response.get('usage')
-        if usage_data:
-            with self._token_usage_lock:
-                self.prompt_tokens += usage_data.get('input_tokens', 0)
-                self.completion_tokens += usage_data.get('output_tokens', 0)
+    def log_usage(self, response) -> tuple:
+        """Log the total tokens from the API response and return them as (prompt_tokens, completion_tokens)."""
+        prompt_tokens, completion_tokens = usage_tokens(response.get('usage'))
+        with self._token_usage_lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+        return prompt_tokens, completion_tokens
 
     def get_usage_and_reset(self):
         """Get the total tokens used and reset the token usage."""
@@ -139,13 +471,20 @@ class QwenModel(dspy.OpenAI):
         assert only_completed, "for now"
         assert return_sorted is False, "for now"
 
-
+        stage, start = current_stage(), time.time()
+        cache_key = get_cache_key(self, prompt, self.kwargs.get('max_tokens'), kwargs)
+        if cache_key is not None:
+            completions = self.completion_cache.get(cache_key)
+            if completions is not None:
+                self.usage_tracker.record(self.model, cached=True, stage=stage)
+                return completions
 
         messages = [{'role': 'user', 'content': prompt}]
         max_retries = 3
         attempt = 0
         while attempt < max_retries:
             try:
+                reserved = reserve_rate_limit(self, prompt, self.kwargs.get('max_tokens'))
                 response = Generation.call(
                     model=self.model, 
                     messages=messages,
@@ -155,11 +494,18 @@ class QwenModel(dspy.OpenAI):
                 break
 
             except Exception as e:
-                delay = random.uniform(0, 10)
-                time.sleep(delay)
+                last_error = e
                 attempt += 1
+                if attempt < max_retries:
+                    time.sleep(backoff_delay(attempt))
+        else:
+            raise LMRequestError(f'Request to {self.model} failed after {max_retries} attempts: {last_error}') \
+                from last_error
 
-        self.log_usage(response)
+        prompt_tokens, completion_tokens = self.log_usage(response)
+        settle_rate_limit(self, reserved, prompt_tokens, completion_tokens)
+        self.usage_tracker.record(self.model, prompt_tokens, completion_tokens, latency=time.time() - start,
+                                  retries=attempt, stage=stage)
 
         completed_choices = [c for c in choices if c["finish_reason"] != "length"]
 
@@ -167,5 +513,51 @@ class QwenModel(dspy.OpenAI):
             choices = completed_choices
 
         completions = [c['message']['content'] for c in choices]
+        if cache_key is not None:
+            self.completion_cache.set(cache_key, completions)
 
         return completions
+
+    async def acall(self, prompt: str, **kwargs) -> List[str]:
+        """Async variant of __call__. The DashScope SDK is blocking, so the call runs in a worker thread."""
+        return await asyncio.to_thread(self.__call__, prompt, **kwargs)
+
+    def stream(self, prompt: str, **kwargs) -> Iterator[str]:
+        """Stream the completion of prompt, yielding text chunks as they arrive."""
+        stage, start = current_stage(), time.time()
+        cache_key = get_cache_key(self, prompt, self.kwargs.get('max_tokens'), kwargs)
+        if cache_key is not None:
+            completions = self.completion_cache.get(cache_key)
+            if completions is not None:
+                self.usage_tracker.record(self.model, cached=True, stage=stage)
+                yield completions[0]
+                return
+
+        reserved = reserve_rate_limit(self, prompt, self.kwargs.get('max_tokens'))
+        responses = Generation.call(
+            model=self.model,
+            messages=[{'role': 'user', 'content': prompt}],
+            result_format='message',
+            stream=True,
+            incremental_output=True,
+        )
+        chunks = []
+        finish_reason = None
+        usage = None
+        for response in responses:
+            if response.status_code != 200:
+                raise LMRequestError(f'Stream from {self.model} failed: {response.code} {response.message}')
+            # Every event carries the usage so far, the last one that of the whole request.
+            usage = response.get('usage') or usage
+            choice = response["output"]["choices"][0]
+            delta = choice['message']['content']
+            if delta:
+                chunks.append(delta)
+                yield delta
+            finish_reason = choice.get('finish_reason') or finish_reason
+        prompt_tokens, completion_tokens = self.log_usage({'usage': usage})
+        settle_rate_limit(self, reserved, prompt_tokens, completion_tokens)
+        self.usage_tracker.record(self.model, prompt_tokens, completion_tokens, latency=time.time() - start,
+                                  stage=stage)
+        if cache_key is not None and finish_reason == 'stop':
+            self.completion_cache.set(cache_key, [''.join(chunks)])
@@ -1,39 +1,79 @@
+import asyncio
 import concurrent.futures
+import contextvars
+import functools
+import hashlib
+import heapq
+import itertools
 import os
 import re
 import json
+import threading
 import dspy
 import sys
 import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
 from concurrent.futures import as_completed
-from typing import Union, List, Tuple, Optional, Dict
+from typing import Callable, Union, List, Tuple, Optional, Dict
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
-from src.utils.ArticleTextProcessing import ArticleTextProcessing
+from src.utils.Checkpoint import Checkpoint, atomic_write
+from src.utils.ConcurrencyBudget import ConcurrencyBudget
+from src.utils.ContextPacker import ContextPacker, context_budget
+from src.utils.EmbeddingCache import EmbeddingCache
+from src.utils.MapStore import CompactMapReader, is_compact_map, save_compact_map
+from src.utils.NearDuplicate import NearDuplicateIndex
+from src.utils.SemanticRegistry import SemanticRegistry
+from src.utils.UsageTracker import UsageMeter, usage_meter, usage_stage
+from src.utils.VectorIndex import create_index, save_index, load_index
 
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
+ENCODER_PATH = '/mnt/nas-alinlp/xizekun/huggingface_cache/all-MiniLM-L6-v2'
+
+
+async def aretrieve(retriever, query_or_queries: Union[str, List[str]], budget: ConcurrencyBudget) -> List[Dict]:
+    """Run one retriever call under the budget's 'search' limit, natively if the retriever has aforward."""
+    if hasattr(retriever, 'aforward'):
+        async with budget.limit('search'):
+            return await retriever.aforward(query_or_queries)
+    return await budget.run('search', retriever, query_or_queries)
 
 
 class ConceptGenerator(dspy.Module):
     """Extract information and generate a list of concepts."""
-    def __init__(self, lm: Union[dspy.dsp.LM, dspy.dsp.HFModel]):
+    # Share of the LM's context window given to the snippets by default.
+    CONTEXT_SHARE = 1 / 8
+
+    def __init__(self, lm: Union[dspy.dsp.LM, dspy.dsp.HFModel], context_tokens: Optional[int] = None):
+        """
+        Args:
+            context_tokens: Token budget of the snippets in the prompt, counted with the tokenizer of lm's model.
+                CONTEXT_SHARE of lm's context window if None.
+        """
         super().__init__()
         self.lm = lm
         self.concept_generator = dspy.Predict(GenConcept)
+        if context_tokens is None:
+            context_tokens = context_budget(lm, self.CONTEXT_SHARE)
+        self.packer = ContextPacker(context_tokens, model=getattr(lm, 'model', None), stage='concept')
 
-    def forward(self, infos: List[Dict]):
+    def forward(self, infos: List[Dict], query: str = ''):
+        """
+        Args:
+            query: What the infos were searched for, e.g. the node's category. The snippets most relevant to it
+                are kept when they do not all fit the token budget.
+        """
         snippets_list = []
         for info in infos:
             snippet = info.get('snippets', [])
             snippets_list.extend(snippet)
-        
+
+        selected, _, _ = self.packer.pack(snippets_list, query=query)
+        snippets_list = [snippets_list[i] for i in selected]
         snippets_list_str = "\n".join(f"{index + 1}. {snippet}" for index, snippet in enumerate(snippets_list))
-        snippets_list_str = ArticleTextProcessing.limit_word_count_preserve_newline(snippets_list_str, 3000)
 
-        with dspy.settings.context(lm=self.lm):
+        with dspy.settings.context(lm=self.lm), usage_stage('concept'):
             concepts = self.concept_generator(info=snippets_list_str).concepts
 
         pattern = r"\d+\.\s*(.*)"
@@ -70,24 +110,217 @@ Present your comprehensive opinion in the format of 1. 2. ..."""
     concepts = dspy.OutputField(format=str)
 
 
+class MindPointContext():
+    """
+    What all the nodes of a map share: the LM and retriever, the map's callback, pool and registry, and the
+    predictors. The predictors are created on first use, so nodes that are never extended (e.g. those of a
+    loaded map) never build one.
+    """
+    __slots__ = ('retriever', 'lm', 'info_callback', 'executor', 'registry',
+                 '_concept_generator', '_extend_concept', '_lock')
+
+    def __init__(self, retriever, lm: Union[dspy.dsp.LM, dspy.dsp.HFModel],
+                 info_callback: Optional[Callable[[List[Dict]], Optional[int]]] = None,
+                 executor: Optional[concurrent.futures.Executor] = None,
+                 registry: Optional[SemanticRegistry] = None):
+        """
+        Args:
+            info_callback: Called with the info of every child created by extend, e.g. MindMap.add_infos. It may
+                return the number of URLs in it that are new to the map, from which the child's novelty is set.
+            executor: Pool on which extend expands the categories of a node concurrently. Categories are
+                expanded one after another if None.
+            registry: Map-wide registry that extend uses to skip categories and keywords already explored
+                elsewhere in the map.
+        """
+        self.retriever = retriever
+        self.lm = lm
+        self.info_callback = info_callback
+        self.executor = executor
+        self.registry = registry
+        self._concept_generator = None
+        self._extend_concept = None
+        self._lock = threading.Lock()
+
+    @property
+    def concept_generator(self) -> ConceptGenerator:
+        if self._concept_generator is None:
+            with self._lock:
+                if self._concept_generator is None:
+                    self._concept_generator = ConceptGenerator(lm=self.lm)
+        return self._concept_generator
+
+    @property
+    def extend_concept(self) -> dspy.Predict:
+        if self._extend_concept is None:
+            with self._lock:
+                if self._extend_concept is None:
+                    self._extend_concept = dspy.Predict(ExtendConcept)
+        return self._extend_concept
+
+
 class MindPoint():
-    def __init__(self, retriever, lm: Union[dspy.dsp.LM, dspy.dsp.HFModel], root: bool = False,
-                 children: Optional[List['MindPoint']] = None, concept: str = '',
-                 info: Optional[List[Dict]] = None, category: str = ''):
+    __slots__ = ('context', 'root', 'category', 'children', 'concept', 'novelty', 'extended',
+                 'failed_categories', '_info', '_info_loader')
+
+    def __init__(self, context: MindPointContext, root: bool = False,
+                 children: Optional[Dict[str, 'MindPoint']] = None, concept: str = '',
+                 info: Optional[List[Dict]] = None, category: str = '', novelty: float = 1.0,
+                 info_loader: Optional[Callable[[], List[Dict]]] = None):
+        """
+        Args:
+            context: Shared by all the nodes of the map, children included.
+            novelty: Share of this node's URLs that were new to the map when it was created.
+            info_loader: Returns the node's info, called the first time info is accessed. Used instead of info
+                by maps loaded from the compact format.
+        """
+        self.context = context
         self.root = root
         self.category = category
         self.children = children if children is not None else {}
         self.concept = concept
-        self.info = info if info is not None else []
-        self.lm = lm
-        self.retriever = retriever
-        self.concept_generator = ConceptGenerator(lm=lm)
+        self._info = info
+        self._info_loader = info_loader
+        self.novelty = novelty
+        # Set once extend has created the children, so a resumed build does not extend the node again.
+        self.extended = False
+        # Categories of an extended node whose expansion failed, with their keywords; a resumed build expands
+        # only these again.
+        self.failed_categories = {}
+
+    @property
+    def info(self) -> List[Dict]:
+        if self._info is None:
+            self._info = self._info_loader() if self._info_loader is not None else []
+            self._info_loader = None
+        return self._info
+
+    @info.setter
+    def info(self, info: List[Dict]):
+        self._info = info
+        self._info_loader = None
     
-    def extend(self):
-        extend_concept = dspy.Predict(ExtendConcept)
-        with dspy.settings.context(lm=self.lm):
-            info='\n'.join([str(i) for i in self.info])
-            keywords = extend_concept(info='\n'.join([str(i) for i in self.info]), concept=self.concept, category = self.category).keywords
+    def extend(self, max_children: Optional[int] = None) -> int:
+        """
+        Break the node down into categories and create a child for each, from a search of its keywords.
+
+        Args:
+            max_children: Create at most this many children, keeping the first categories.
+
+        Returns:
+            The number of search queries issued.
+
+        A category that fails is reported and skipped; the children of the others are kept, and the failed
+        categories are recorded in failed_categories. If every category fails, the first error is raised and
+        the node stays unextended. Extending a node that has failed categories expands only those again.
+        """
+        if self.failed_categories:
+            categories = self.retry_categories(max_children)
+        else:
+            categories = self.select_categories(self.predict_keywords(), max_children)
+        context = self.context
+
+        def expand(category, keywords_list):
+            # Each category goes from search to concept on its own, without waiting for the other searches.
+            new_info = context.retriever(keywords_list)
+            novelty = self.register_info(new_info)
+            new_concept = context.concept_generator.forward(new_info, category)
+            return MindPoint(context, concept=new_concept, info=new_info, category=category, novelty=novelty)
+
+        results = []
+        if context.executor is None or len(categories) <= 1:
+            for category, keywords_list in categories.items():
+                try:
+                    results.append((category, expand(category, keywords_list)))
+                except Exception as e:
+                    results.append((category, e))
+        else:
+            # Copy the context so that the usage stage and meters of this extend follow into the pool.
+            futures = {category: context.executor.submit(contextvars.copy_context().run, expand, category,
+                                                         keywords_list)
+                       for category, keywords_list in categories.items()}
+            for category, future in futures.items():
+                error = future.exception()
+                results.append((category, error if error is not None else future.result()))
+        self.add_children(results, categories)
+        return sum(len(keywords_list) for keywords_list in categories.values())
+
+    async def aextend(self, budget: ConcurrencyBudget, max_children: Optional[int] = None) -> int:
+        """
+        Async variant of extend: the searches and concept generation of all categories run concurrently,
+        within the limits of budget.
+        """
+        if self.failed_categories:
+            categories = self.retry_categories(max_children)
+        else:
+            categories = await budget.run('encode', self.select_categories,
+                                          await budget.run('llm', self.predict_keywords), max_children)
+        context = self.context
+
+        async def expand(category, keywords_list):
+            new_info = await aretrieve(context.retriever, keywords_list, budget)
+            # Registering hashes and deduplicates every snippet, too much CPU to run on the event loop.
+            novelty = await budget.run('encode', self.register_info, new_info)
+            new_concept = await budget.run('llm', context.concept_generator.forward, new_info, category)
+            return category, MindPoint(context, concept=new_concept, info=new_info, category=category,
+                                       novelty=novelty)
+
+        results = await asyncio.gather(*(expand(c, k) for c, k in categories.items()), return_exceptions=True)
+        for result in results:
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+        self.add_children([result if isinstance(result, tuple) else (category, result)
+                           for category, result in zip(categories, results)], categories)
+        return sum(len(keywords_list) for keywords_list in categories.values())
+
+    def add_children(self, results: List[Tuple[str, Union['MindPoint', BaseException]]],
+                     categories: Dict[str, List[str]]):
+        """
+        Attach the children of the expanded categories, record the failed ones with their keywords, and mark
+        the node extended. Raises the first error if the node is left without any child.
+        """
+        errors = []
+        failed_categories = {}
+        for category, result in results:
+            if isinstance(result, BaseException):
+                print(f'Error while expanding category {category!r} of {self.category!r}: {result!r}')
+                errors.append(result)
+                failed_categories[category] = categories[category]
+            else:
+                self.children[category] = result
+        if errors and not self.children:
+            raise errors[0]
+        self.failed_categories = failed_categories
+        self.extended = True
+
+    def retry_categories(self, max_children: Optional[int] = None) -> Dict[str, List[str]]:
+        """The failed categories to expand again, at most max_children of them."""
+        if max_children is None:
+            return dict(self.failed_categories)
+        return dict(itertools.islice(self.failed_categories.items(), max(0, max_children)))
+
+    def register_info(self, new_info: List[Dict]) -> float:
+        """Pass the info of a new child to info_callback and return the child's novelty."""
+        info_callback = self.context.info_callback
+        new_urls = info_callback(new_info) if info_callback is not None else None
+        if new_urls is None:
+            return 1.0
+        return new_urls / len(new_info) if new_info else 0.0
+
+    def predict_keywords(self) -> str:
+        with dspy.settings.context(lm=self.context.lm), usage_stage('extend'):
+            return self.context.extend_concept(info='\n'.join([str(i) for i in self.info]), concept=self.concept,
+                                  category=self.category).keywords
+
+    def select_categories(self, keywords: str, max_children: Optional[int] = None) -> Dict[str, List[str]]:
+        """The categories to expand from the ExtendConcept output, without the duplicates the registry knows of."""
+        registry = self.context.registry
+        if registry is None:
+            return self.parse_categories(keywords, max_children)
+        return registry.filter_categories(self.parse_categories(keywords), max_children)
+
+    @staticmethod
+    def parse_categories(keywords: str, max_categories: Optional[int] = None) -> Dict[str, List[str]]:
+        """Parse the ExtendConcept output into {category: [keyword, ...]}, keeping at most max_categories."""
         categories = {}
         current_category = None
         for line in keywords.split('\n'):
@@ -99,12 +332,115 @@ class MindPoint():
                 keyword = line[3:-1].strip()
                 if keyword:
                     categories[current_category].append(keyword)
+        if max_categories is not None:
+            categories = dict(itertools.islice(categories.items(), max(0, max_categories)))
+        return categories
+
+
+class ExpansionFrontier():
+    """
+    Work queue of one map build: the nodes waiting to be extended, the most novel first and then the shallowest,
+    and the caps on how far the build may grow.
+
+    The node cap is strict: every extension may create as many children as the room left under it, and
+    reserves about as many as the extensions so far created on average. While the reservations of running
+    extensions leave no room, the next node waits for them to complete. An extension that completes with more
+    children than the room its concurrent extensions left keeps its first categories only. The search and
+    token caps are checked before each extension is started, so extensions already running may overshoot
+    them. It is only used from the thread (or event loop) driving the build.
+    """
+
+    # Children reserved per extension under a node cap before any extension has completed.
+    CHILDREN_PER_NODE = 4
+
+    def __init__(self, depth: int, max_nodes: Optional[int] = None, max_searches: Optional[int] = None,
+                 max_tokens: Optional[int] = None):
+        self.depth = depth
+        self.max_nodes = max_nodes
+        self.max_searches = max_searches
+        self.max_tokens = max_tokens
+        self.meter = UsageMeter()
+        self.nodes = 0
+        self.searches = 0
+        self._reserved = 0
+        self._reservations = {}
+        self._extensions = 0
+        self._children = 0
+        self._heap = []
+        self._order = itertools.count()
 
-        for category, keywords_list in categories.items():
-            new_info = self.retriever(keywords_list)
-            new_concept = self.concept_generator.forward(new_info)
-            new_node = MindPoint(concept=new_concept, info=new_info, lm=self.lm, retriever=self.retriever, category=category)
-            self.children[category] = new_node
+    def add(self, node: MindPoint, level: int):
+        self.nodes += 1
+        if level < self.depth - 1:
+            heapq.heappush(self._heap, (-node.novelty, level, next(self._order), node))
+
+    def exhausted(self) -> bool:
+        """Whether a cap is reached for good, so that no more node will be extended."""
+        return (self.max_nodes is not None and self.nodes >= self.max_nodes) \
+            or (self.max_searches is not None and self.searches >= self.max_searches) \
+            or (self.max_tokens is not None and self.meter.total_tokens >= self.max_tokens)
+
+    def expected_children(self) -> int:
+        """Children to reserve for the next extension: the average so far, rounded up."""
+        if not self._extensions:
+            return self.CHILDREN_PER_NODE
+        return max(1, -(-self._children // self._extensions))
+
+    def pop(self) -> Optional[Tuple[MindPoint, int, Optional[int]]]:
+        """
+        The next node to extend as (node, level, max_children), or None if no node is waiting, a cap is
+        reached, or the running extensions have reserved all the nodes left (then the node stays queued).
+        max_children is all the room the running extensions have not reserved; only expected_children of
+        it is reserved. Nodes restored already extended are skipped, and their children queued, unless some
+        of their categories failed; those are then extended again.
+        """
+        while self._heap:
+            if self.exhausted():
+                self._heap.clear()
+                return None
+            entry = heapq.heappop(self._heap)
+            _, level, _, node = entry
+            if node.extended and not node.failed_categories:
+                for child in node.children.values():
+                    self.add(child, level + 1)
+                continue
+            max_children = None
+            if self.max_nodes is not None:
+                available = self.max_nodes - self.nodes - self._reserved
+                if available <= 0:
+                    heapq.heappush(self._heap, entry)
+                    return None
+                max_children = available
+                self._reservations[id(node)] = min(self.expected_children(), available)
+                self._reserved += self._reservations[id(node)]
+            return node, level, max_children
+        return None
+
+    def complete(self, node: MindPoint, level: int, max_children: Optional[int], searches: int):
+        """
+        Account a finished (or failed) extension and queue the node's children, dropping those beyond the room
+        left by the reservations of the other running extensions.
+        """
+        self._reserved -= self._reservations.pop(id(node), 0)
+        self.searches += searches
+        if node.extended:
+            self._extensions += 1
+            self._children += len(node.children)
+            if self.max_nodes is not None:
+                room = max(0, self.max_nodes - self.nodes - self._reserved)
+                if len(node.children) > room:
+                    node.children = dict(itertools.islice(node.children.items(), room))
+        for child in node.children.values():
+            self.add(child, level + 1)
+
+    def extend(self, node: MindPoint, max_children: Optional[int]) -> int:
+        """Extend node, counting its LM tokens on this frontier. Run in a worker thread."""
+        with usage_meter(self.meter):
+            return node.extend(max_children=max_children)
+
+    async def aextend(self, node: MindPoint, budget: ConcurrencyBudget, max_children: Optional[int]) -> int:
+        with usage_meter(self.meter):
+            return await node.aextend(budget, max_children=max_children)
 
 
 class MindMap():
@@ -112,42 +448,267 @@ class MindMap():
                  retriever, 
                  gen_concept_lm: Union[dspy.dsp.LM, dspy.dsp.HFModel],
                  depth: int,
-                 workers: int = 5
+                 workers: int = 5,
+                 index_type: str = 'brute_force',
+                 index_kwargs: Optional[Dict] = None,
+                 embedding_cache_dir: Optional[str] = None,
+                 encoder: Optional[SentenceTransformer] = None,
+                 encoder_name: Optional[str] = None,
+                 checkpoint_dir: Optional[str] = None,
+                 max_nodes: Optional[int] = None,
+                 max_searches: Optional[int] = None,
+                 max_tokens: Optional[int] = None,
+                 category_workers: int = 8,
+                 dedup_threshold: Optional[float] = 0.9,
+                 snippet_dedup_threshold: Optional[float] = 0.8,
                  ):
+        """
+        Args:
+            index_type: Vector index used by retrieve_information, 'brute_force' (exact) or 'ivf' (approximate).
+            index_kwargs: Extra arguments for the vector index, e.g. {'n_probe': 8} for 'ivf'.
+            embedding_cache_dir: If set, snippet embeddings are cached on disk there and reused across runs.
+            encoder: An already loaded encoder to use, e.g. one shared by several maps. Loaded lazily if None.
+            encoder_name: Name of encoder, under which its embeddings are cached. Taken from the encoder's model
+                card if not given; a custom encoder whose name is unknown cannot use the embedding cache.
+            checkpoint_dir: If set, build_map persists every node there as soon as it is complete, and
+                build_map(resume=True) continues from what was persisted.
+            workers: Maximum number of nodes extended at the same time.
+            max_nodes, max_searches, max_tokens: Caps on the total number of nodes, search queries and LM tokens
+                of one build. Nodes are extended most novel first until the depth is reached or a cap is hit.
+            category_workers: Size of the pool shared by all nodes to search and summarize their categories
+                concurrently in MindPoint.extend.
+            dedup_threshold: Cosine similarity from which a new category or keyword counts as a duplicate of
+                one already explored in the map and is skipped. None disables the deduplication.
+            snippet_dedup_threshold: Estimated Jaccard similarity (of character shingles) from which a snippet
+                counts as a near-duplicate of one already in the retrieval table. It then gets no row of its own;
+                its URL is kept as a duplicate URL of that row instead. None disables the collapsing.
+        """
         self.retriever = retriever
         self.gen_concept_lm = gen_concept_lm
         self.depth = depth
-        self.concept_generator = ConceptGenerator(lm=self.gen_concept_lm)
         self.root = None
         self.max_workers = workers
+        self.max_nodes = max_nodes
+        self.max_searches = max_searches
+        self.max_tokens = max_tokens
+        self.category_executor = concurrent.futures.ThreadPoolExecutor(max_workers=category_workers,
+                                                                       thread_name_prefix='mindmap-category')
+        self.index_type = index_type
+        self.index_kwargs = index_kwargs or {}
+        self.encoder = encoder
+        self.registry = SemanticRegistry(self.encode_texts, dedup_threshold) if dedup_threshold is not None else None
+        self.node_context = MindPointContext(retriever, gen_concept_lm, info_callback=self.add_infos,
+                                             executor=self.category_executor, registry=self.registry)
+        self.embedding_cache = None
+        if embedding_cache_dir:
+            self.embedding_cache = EmbeddingCache(embedding_cache_dir, self.get_encoder_name(encoder, encoder_name))
+        self.snippet_dedup_threshold = snippet_dedup_threshold
+        self.index = None
+        self._table_lock = threading.Lock()
+        self._encode_executor = None
+        self.checkpoint = Checkpoint(checkpoint_dir) if checkpoint_dir else None
+        self._node_keys = {}
+        self.reset_retrieval_table()
         print('MindMap initialized')
 
-    def build_map(self, topic: str):
-        root_info = self.retriever(topic)
-        root_concept = self.concept_generator(root_info)
-        root = MindPoint(root=True, info=root_info, concept=root_concept, lm=self.gen_concept_lm, retriever=self.retriever, category=topic)
+    def build_map(self, topic: str, resume: bool = False):
+        """
+        Build the map of topic, yielding every node as soon as it has been extended.
+
+        Nodes are extended by up to `workers` threads, each as soon as its parent is done, so one slow node
+        does not hold back the others. See ExpansionFrontier for the order and the caps.
+        """
+        root = self.start_map(topic, resume)
+        frontier = self.create_frontier()
+        frontier.add(root, 0)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {}
+            while True:
+                while len(running) < self.max_workers:
+                    task = frontier.pop()
+                    if task is None:
+                        break
+                    node, level, max_children = task
+                    running[executor.submit(frontier.extend, node, max_children)] = task
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    node, level, max_children = running.pop(future)
+                    if future.exception() is not None:
+                        print(f'Error while extending {node.category!r}: {future.exception()!r}')
+                        frontier.complete(node, level, max_children, 0)
+                        continue
+                    frontier.complete(node, level, max_children, future.result())
+                    self.checkpoint_node(node)
+                    yield node
+
+    def reset_registry(self, root: Optional[MindPoint] = None):
+        """Start deduplication afresh, knowing the categories of root's tree if a map is being resumed."""
+        if self.registry is None:
+            return
+        self.registry.reset()
+        if root is not None:
+            categories = []
+
+            def traverse(node: MindPoint):
+                categories.extend(node.children.keys())
+                for child in node.children.values():
+                    traverse(child)
+
+            traverse(root)
+            self.registry.register_categories(categories)
+
+    def get_dedup_stats(self) -> Dict[str, int]:
+        """
+        How many categories and keywords the registry skipped, and the searches and LM calls that saved, and
+        how many snippets were collapsed into a near-duplicate row of the retrieval table.
+        """
+        stats = self.registry.get_stats() if self.registry is not None else {}
+        stats['snippets_collapsed'] = self.snippets_collapsed
+        return stats
+
+    def create_frontier(self) -> ExpansionFrontier:
+        return ExpansionFrontier(self.depth, max_nodes=self.max_nodes, max_searches=self.max_searches,
+                                 max_tokens=self.max_tokens)
+
+    def start_map(self, topic: str, resume: bool = False) -> MindPoint:
+        """Create the root of a new map, or restore the checkpointed map of topic if resume is set."""
+        root = self.restore_map(topic, resume)
+        if root is None:
+            root_info = self.retriever(topic)
+            self.add_infos(root_info)
+            root = self.create_root(topic, root_info, self.node_context.concept_generator(root_info, topic))
+        return root
+
+    def restore_map(self, topic: str, resume: bool = False) -> Optional[MindPoint]:
+        """
+        Reset the build state, then restore the checkpointed map of topic if resume is set. Returns its root,
+        or None if a new root has to be created.
+        """
+        self.reset_retrieval_table()
+        self._node_keys = {}
+        root = self.restore_checkpoint(topic) if resume else None
+        self.reset_registry(root)
+        if root is not None:
+            self.root = root
+            self.add_infos(self.get_all_infos())
+        return root
+
+    def create_root(self, topic: str, root_info: List[Dict], root_concept: List[str]) -> MindPoint:
+        """Make the root of a new map from the search of topic, and checkpoint it."""
+        root = MindPoint(self.node_context, root=True, info=root_info, concept=root_concept, category=topic)
         self.root = root
-        
-        current_level = [root]
-        
-        for count in range(self.depth):
-            next_level = []
+        self._node_keys[id(root)] = 'root'
+        self.checkpoint_node(root)
+        return root
+
+    @staticmethod
+    def node_key(parent_key: str, category: str) -> str:
+        return hashlib.sha1(f'{parent_key}\0{category}'.encode('utf-8')).hexdigest()
 
-            yield current_level
-            if count == self.depth - 1:  # Check if it's the last layer
+    def checkpoint_node(self, node: MindPoint):
+        """
+        Persist node, and its children before it, so that the node is only recorded as extended once all of
+        its children are on disk.
+        """
+        if self.checkpoint is None:
+            return
+        key = self._node_keys[id(node)]
+        for category, child in node.children.items():
+            child_key = self.node_key(key, category)
+            self._node_keys[id(child)] = child_key
+            if not child.extended:
+                self.checkpoint.save_json(f'nodes/{child_key}.json', self._node_record(child))
+        self.checkpoint.save_json(f'nodes/{key}.json', self._node_record(node))
+
+    @staticmethod
+    def _node_record(node: MindPoint) -> Dict:
+        return {
+            'category': node.category,
+            'concept': node.concept,
+            'info': node.info,
+            'extended': node.extended,
+            'failed_categories': node.failed_categories,
+            'novelty': node.novelty,
+            'children': list(node.children.keys()),
+        }
+
+    def restore_checkpoint(self, topic: str) -> Optional[MindPoint]:
+        """Rebuild the map of topic from the checkpointed nodes, or return None if there is none."""
+        if self.checkpoint is None:
+            return None
+
+        def restore(key: str, root: bool = False) -> Optional[MindPoint]:
+            record = self.checkpoint.load_json(f'nodes/{key}.json')
+            if record is None:
+                return None
+            node = MindPoint(self.node_context, root=root, concept=record['concept'], info=record['info'],
+                             category=record['category'], novelty=record.get('novelty', 1.0))
+            self._node_keys[id(node)] = key
+            if record['extended']:
+                for category in record['children']:
+                    node.children[category] = restore(self.node_key(key, category))
+                node.extended = all(child is not None for child in node.children.values())
+                if node.extended:
+                    node.failed_categories = record.get('failed_categories', {})
+                else:
+                    node.children = {}
+            return node
+
+        root = restore('root', root=True)
+        if root is None or root.category != topic:
+            return None
+        return root
+
+    async def abuild_map(self, topic: str, budget: Optional[ConcurrencyBudget] = None,
+                         resume: bool = False) -> MindPoint:
+        """
+        Async variant of build_map that returns the finished root. Up to `workers` nodes are extended at a time
+        and their searches and LM calls overlap, bounded by budget (by default `workers` concurrent LM calls).
+        """
+        own_budget = budget is None
+        budget = budget or ConcurrencyBudget(llm=self.max_workers)
+        try:
+            return await self._abuild_map(topic, budget, resume)
+        finally:
+            if own_budget:
+                budget.shutdown()
+
+    async def _abuild_map(self, topic: str, budget: ConcurrencyBudget, resume: bool) -> MindPoint:
+        root = await budget.run('encode', self.restore_map, topic, resume)
+        if root is None:
+            root_info = await aretrieve(self.retriever, topic, budget)
+            await budget.run('encode', self.add_infos, root_info)
+            root_concept = await budget.run('llm', self.node_context.concept_generator, root_info, topic)
+            root = await asyncio.to_thread(self.create_root, topic, root_info, root_concept)
+
+        frontier = self.create_frontier()
+        frontier.add(root, 0)
+        running = {}
+        while True:
+            while len(running) < self.max_workers:
+                task = frontier.pop()
+                if task is None:
+                    break
+                node, level, max_children = task
+                running[asyncio.ensure_future(frontier.aextend(node, budget, max_children))] = task
+            if not running:
                 break
-            
-            with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-                futures = {executor.submit(node.extend): node for node in current_level}
-                
-                for future in concurrent.futures.as_completed(futures):
-                    node = futures[future]
-                    # Assuming extend populates children.
-                    next_level.extend(node.children.values())
-            
-            yield current_level
-            current_level = next_level
-    
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                node, level, max_children = running.pop(future)
+                if future.exception() is not None:
+                    print(f'Error while extending {node.category!r}: {future.exception()!r}')
+                    frontier.complete(node, level, max_children, 0)
+                    continue
+                frontier.complete(node, level, max_children, future.result())
+                await asyncio.to_thread(self.checkpoint_node, node)
+        return root
+
     def recursive_extend(self, node: MindPoint, count: int):
         if count >= self.depth:
             return
@@ -155,7 +716,18 @@ class MindMap():
         count += 1
 
 
-    def save_map(self, root: MindPoint, filename: str):
+    def save_map(self, root: MindPoint, filename: str, compact: bool = False):
+        """
+        Save the map under root, and the retrieval table next to it.
+
+        Args:
+            compact: Save in the compact format of src.utils.MapStore, a single compressed file holding the map
+                and the retrieval table, instead of a JSON file plus index file. load_map reads both formats.
+        """
+        if compact:
+            self.save_compact_map(root, filename)
+            return
+
         def serialize_node(node: MindPoint):
             return {
                 'category': node.category,
@@ -165,17 +737,39 @@ class MindMap():
             }
         
         mind_map_dict = serialize_node(root)
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(mind_map_dict, f, ensure_ascii=False, indent=2)
+        # The index goes first, so that a map file on disk always has its index next to it.
+        if self.index is not None:
+            self.save_retrieval_table(self.index_filename(filename))
+        atomic_write(filename, json.dumps(mind_map_dict, ensure_ascii=False, indent=2).encode('utf-8'))
+
+    def save_compact_map(self, root: MindPoint, filename: str):
+        nodes = []
+
+        def flatten(node: MindPoint, parent: int):
+            nodes.append({'parent': parent, 'category': node.category, 'concept': node.concept,
+                          'novelty': node.novelty, 'info': node.info})
+            position = len(nodes) - 1
+            for child in node.children.values():
+                flatten(child, position)
+
+        flatten(root, -1)
+        with self._table_lock:
+            index, urls, snippets = self.index, list(self.collected_urls), list(self.collected_snippets)
+            duplicate_urls = dict(self.duplicate_urls)
+        save_compact_map(filename, nodes, index=index, table_urls=urls, table_snippets=snippets,
+                         table_duplicate_urls=duplicate_urls)
 
     def load_map(self, filename: str):
+        if is_compact_map(filename):
+            return self.load_compact_map(filename)
+
         def deserialize_node(node_data):
             category = node_data['category']
             concept = node_data['concept']
             info = node_data['info']
             children_data = node_data['children']
 
-            node = MindPoint(concept=concept, info=info, lm=self.gen_concept_lm, retriever=self.retriever, category=category)
+            node = MindPoint(self.node_context, concept=concept, info=info, category=category)
             node.children = {k: deserialize_node(v) for k, v in children_data.items()}
             return node
         
@@ -183,8 +777,55 @@ class MindMap():
             mind_map_dict = json.load(f)
         
         self.root = deserialize_node(mind_map_dict)
+        if os.path.exists(self.index_filename(filename)):
+            self.load_retrieval_table(self.index_filename(filename))
         return self.root
 
+    def load_compact_map(self, filename: str):
+        """Load a map saved with save_map(compact=True). The info of each node is decoded on first access."""
+        reader = CompactMapReader(filename)
+        nodes = []
+        for i in range(len(reader)):
+            node = MindPoint(self.node_context, root=i == 0, concept=reader.concept(i), category=reader.category(i),
+                             novelty=float(reader.novelties[i]), info_loader=functools.partial(reader.node_infos, i))
+            if reader.parents[i] >= 0:
+                nodes[reader.parents[i]].children[node.category] = node
+            nodes.append(node)
+
+        self.root = nodes[0]
+        if reader.has_retrieval_table():
+            self.set_retrieval_table(*reader.retrieval_table())
+        return self.root
+
+    @staticmethod
+    def index_filename(map_filename: str) -> str:
+        """The retrieval table and its vector index are stored next to the map JSON."""
+        return f'{map_filename}.index.npz'
+
+    def save_retrieval_table(self, filename: str):
+        table = json.dumps({'urls': self.collected_urls, 'snippets': self.collected_snippets,
+                            'duplicate_urls': self.duplicate_urls}, ensure_ascii=False).encode('utf-8')
+        save_index(self.index, filename, table=np.frombuffer(table, dtype=np.uint8))
+
+    def load_retrieval_table(self, filename: str):
+        """Restore the snippet table and vector index saved by save_retrieval_table without re-encoding."""
+        index, extra = load_index(filename)
+        table = json.loads(extra['table'].tobytes().decode('utf-8'))
+        duplicate_urls = {int(row): urls for row, urls in table.get('duplicate_urls', {}).items()}
+        self.set_retrieval_table(table['urls'], table['snippets'], index, duplicate_urls)
+
+    def set_retrieval_table(self, urls: List[str], snippets: List[str], index,
+                            duplicate_urls: Optional[Dict[int, List[str]]] = None):
+        with self._table_lock:
+            self.collected_urls = urls
+            self.collected_snippets = snippets
+            self.duplicate_urls = duplicate_urls or {}
+            self._near_duplicates = None
+            self._seen_urls = self.table_urls()
+            self.encoded_snippets = index.embeddings
+            self._embedding_chunks = [index.embeddings]
+            self.index = index
+
     def export_categories_and_concepts(self) -> str:
         root = self.root
         output = []
@@ -220,43 +861,154 @@ class MindMap():
         self.all_infos = all_infos
         return all_infos
 
+    @staticmethod
+    def get_encoder_name(encoder: Optional[SentenceTransformer], encoder_name: Optional[str] = None) -> str:
+        """The model name that embeddings of encoder are cached under."""
+        if encoder_name:
+            return encoder_name
+        if encoder is None:
+            return ENCODER_PATH
+        model_card = getattr(encoder, 'model_card_data', None)
+        name = getattr(model_card, 'base_model', None) or getattr(model_card, 'model_name', None)
+        if not name:
+            raise ValueError('Pass encoder_name with a custom encoder, so that the embedding cache does not mix '
+                             'up its embeddings with those of another model')
+        return name
+
+    def get_encoder(self):
+        if self.encoder is None:
+            self.encoder = SentenceTransformer(ENCODER_PATH)
+        return self.encoder
+
+    def encode_texts(self, texts: List[str]) -> np.ndarray:
+        return self.get_encoder().encode(texts, show_progress_bar=False)
+
+    def encode_snippets(self, snippets: List[str], show_progress_bar: bool = True) -> np.ndarray:
+        """Encode snippets, going through the embedding cache when one is configured."""
+        encode_fn = lambda texts: self.get_encoder().encode(texts, show_progress_bar=show_progress_bar)
+        if self.embedding_cache is None:
+            return encode_fn(snippets)
+        return self.embedding_cache.encode(snippets, encode_fn)
+
+    def reset_retrieval_table(self):
+        with self._table_lock:
+            self.collected_urls = []
+            self.collected_snippets = []
+            self._seen_urls = set()
+            # Row -> the other URLs with a near-duplicate of the row's snippet.
+            self.duplicate_urls = {}
+            self._near_duplicates = None
+            self.snippets_collapsed = 0
+            self.encoded_snippets = None
+            self._embedding_chunks = []
+            self.index = None
+
+    def table_urls(self) -> set:
+        """Every URL with a snippet in the retrieval table, including those only kept as duplicate URLs."""
+        urls = set(self.collected_urls)
+        for duplicates in self.duplicate_urls.values():
+            urls.update(duplicates)
+        return urls
+
+    def find_near_duplicate(self, snippet: str) -> Optional[int]:
+        """
+        The row of the retrieval table holding a near-duplicate of snippet, or None, in which case snippet is
+        registered as the next row. Called with the table lock held.
+        """
+        if self.snippet_dedup_threshold is None:
+            return None
+        if self._near_duplicates is None:
+            # Built on first use, so that a loaded table only pays for it if more snippets are added.
+            self._near_duplicates = NearDuplicateIndex(threshold=self.snippet_dedup_threshold)
+            for existing in self.collected_snippets:
+                self._near_duplicates.add(existing)
+        return self._near_duplicates.find_or_add(snippet)
+
+    def add_infos(self, infos: List[Dict]) -> int:
+        """
+        Append the snippets of not yet seen URLs to the retrieval table and encode them in the background.
+        A snippet that nearly duplicates one already in the table is not added; its URL is recorded as a
+        duplicate URL of that row instead, so mirrors and repeated boilerplate are encoded and retrieved once.
+
+        build_map registers this as the MindPoint info callback, so snippets are encoded while the next
+        searches and LM calls are still running instead of all at once after the map is finished.
+
+        Returns:
+            The number of URLs that were not seen before.
+        """
+        new_snippets = []
+        new_urls = 0
+        with self._table_lock:
+            for info in infos:
+                url = info.get('url')
+                if url and url not in self._seen_urls:
+                    self._seen_urls.add(url)
+                    new_urls += 1
+                    for snippet in info.get('snippets', []):
+                        row = self.find_near_duplicate(snippet)
+                        if row is not None:
+                            self.snippets_collapsed += 1
+                            if url != self.collected_urls[row] and url not in self.duplicate_urls.get(row, []):
+                                self.duplicate_urls.setdefault(row, []).append(url)
+                            continue
+                        self.collected_urls.append(url)
+                        self.collected_snippets.append(snippet)
+                        new_snippets.append(snippet)
+            if new_snippets:
+                if self._encode_executor is None:
+                    self._encode_executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix='mindmap-encode')
+                self._embedding_chunks.append(
+                    self._encode_executor.submit(self.encode_snippets, new_snippets, False))
+        return new_urls
+
     def prepare_table_for_retrieval(self):
         """
         Prepare collected snippets and URLs for retrieval by encoding the snippets using paraphrase-MiniLM-L6-v2.
         collected_urls and collected_snippets have corresponding indices.
+        The table is normally filled incrementally by build_map; it is only rebuilt from the map when it does
+        not cover the map's URLs (e.g. after load_map without a saved index). Rows of URLs the map does not
+        hold (e.g. the info of a category whose expansion failed after its search) are kept rather than
+        re-encoding everything else. An index that is already up to date is reused.
         """
-        self.encoder = SentenceTransformer('/mnt/nas-alinlp/xizekun/huggingface_cache/all-MiniLM-L6-v2')
-        self.collected_urls = []
-        self.collected_snippets = []
-        seen_urls = set()
+        map_urls = {info['url'] for info in self.get_all_infos() if info.get('snippets')}
+        if not map_urls <= self.table_urls():
+            self.reset_retrieval_table()
+            self.add_infos(self.all_infos)
 
-        for info in self.get_all_infos():
-            url = info.get('url')
-            snippets = info.get('snippets', [])
-            if url and url not in seen_urls:
-                seen_urls.add(url)
-                for snippet in snippets:
-                    self.collected_urls.append(url)
-                    self.collected_snippets.append(snippet)
-
-        self.encoded_snippets = self.encoder.encode(self.collected_snippets, show_progress_bar=True)
+        with self._table_lock:
+            if self.index is not None and len(self.index) == len(self.collected_snippets):
+                return
+            chunks = [c.result() if isinstance(c, concurrent.futures.Future) else c for c in self._embedding_chunks]
+            self._embedding_chunks = chunks
+            self.encoded_snippets = np.concatenate(chunks) if chunks else np.zeros((0, 0), dtype=np.float32)
+            self.index = create_index(self.index_type, **self.index_kwargs).build(self.encoded_snippets)
 
     def retrieve_information(self, queries: Union[List[str], str], search_top_k) -> List[Dict[str, any]]:
         """
         Retrieve relevant information based on the given queries.
-        Returns a list of dictionaries containing 'url' and 'snippets'.
+        Returns a list of dictionaries containing 'url' and 'snippets', plus 'duplicate_urls' listing the other
+        sources of the snippets if some were collapsed as near-duplicates.
         """
         selected_urls = []
         selected_snippets = []
+        url_to_duplicates = {}
         if type(queries) is str:
             queries = [queries]
-        for query in queries:
-            encoded_query = self.encoder.encode(query, show_progress_bar=False)
-            sim = cosine_similarity([encoded_query], self.encoded_snippets)[0]
-            sorted_indices = np.argsort(sim)
-            for i in sorted_indices[-search_top_k:][::-1]:
+        if not queries:
+            return []
+
+        # Encode all queries in one forward pass and score them against the table in a single search.
+        encoded_queries = self.get_encoder().encode(list(queries), show_progress_bar=False)
+        _, indices = self.index.search(encoded_queries, search_top_k)
+        for row in indices:
+            for i in row:
+                if i < 0:
+                    continue
                 selected_urls.append(self.collected_urls[i])
                 selected_snippets.append(self.collected_snippets[i])
+                for duplicate_url in self.duplicate_urls.get(i, []):
+                    url_to_duplicates.setdefault(self.collected_urls[i], {})[duplicate_url] = None
 
         url_to_snippets = {}
         for url, snippet in zip(selected_urls, selected_snippets):
@@ -270,6 +1022,8 @@ class MindMap():
                 'url': url,
                 'snippets': list(snippets)
             })
+            if url in url_to_duplicates:
+                result[-1]['duplicate_urls'] = list(url_to_duplicates[url])
 
         return result
 
@@ -1,11 +1,19 @@
+import asyncio
+import concurrent.futures
+import copy
+import itertools
 import logging
 import os
-from typing import Callable, Union, List
+from typing import Callable, Dict, Union, List, Optional
 import dspy
 import requests
 import re
+import unicodedata
 import uuid
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from src.utils.DiskCache import DiskCache
 from src.utils.WebPageHelper import WebPageHelper
 
 
@@ -17,10 +25,164 @@ def clean_text(res):
     result = re.sub(r"\n\n+", "\n", result)
     return result
 
+
+class UsageCounter:
+    """
+    Counter that many threads can increment without taking a lock.
+
+    Increments advance an itertools.count, whose __next__ is atomic in CPython. Reading the total also advances
+    the count once, which get_and_reset accounts for.
+    """
+
+    def __init__(self):
+        self._count = itertools.count()
+        self._base = 0
+
+    def add(self, n: int = 1):
+        for _ in range(n):
+            next(self._count)
+
+    def get_and_reset(self) -> int:
+        current = next(self._count)
+        usage = current - self._base
+        self._base = current + 1
+        return usage
+
+
+class SearchCache:
+    """
+    Persistent cache of search results keyed by normalized query, shared by every retriever (and process)
+    using the same cache_dir.
+
+    Only the raw search hits (url, title, description) are cached; pages are still fetched through the
+    WebPageHelper and its own page cache.
+    """
+
+    def __init__(self, cache_dir: str, namespace: str, ttl: float = 7 * 24 * 3600, max_entries: int = 100000):
+        """
+        Args:
+            cache_dir: Directory of the cache database.
+            namespace: Separates entries of different search backends and result counts.
+            ttl: Time to live of an entry in seconds.
+            max_entries: Maximum number of cached queries, evicting the least recently used ones.
+        """
+        self.namespace = namespace
+        self.cache = DiskCache(os.path.join(cache_dir, 'search.sqlite'), table='search_results', ttl=ttl,
+                               max_entries=max_entries)
+        self.hits = UsageCounter()
+        self.misses = UsageCounter()
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """
+        Case-fold, unify unicode forms and collapse whitespace. Punctuation is kept: it can change what is
+        searched for, e.g. "C# tutorial" and "C tutorial".
+        """
+        return ' '.join(unicodedata.normalize('NFKC', query).casefold().split())
+
+    def search(self, query: str, search_fn: Callable[[str], List[Dict]]) -> List[Dict]:
+        key = f'{self.namespace}\0{self.normalize_query(query)}'
+        results = self.cache.get(key)
+        if results is not None:
+            self.hits.add()
+            return results
+        self.misses.add()
+        results = search_fn(query)
+        if results:  # an empty answer is more likely a transient failure than a fact worth keeping
+            self.cache.set(key, results)
+        return results
+
+    def get_usage_and_reset(self) -> Dict[str, int]:
+        return {'search_cache_hits': self.hits.get_and_reset(), 'search_cache_misses': self.misses.get_and_reset()}
+
+
+def create_search_session(pool_size: int, max_retries: int) -> requests.Session:
+    """
+    A pooled session that keeps connections to the search endpoint alive and retries failed requests
+    (connection errors, 429 and 5xx, including POSTs) with exponential backoff.
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=None,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def search_concurrently(search_fn: Callable[[str], List[Dict]], queries: List[str],
+                        max_threads: int) -> List[List[Dict]]:
+    """
+    Run search_fn on every query with at most max_threads queries in flight.
+
+    Returns:
+        The results of each query, in the order of queries. A failed query is logged and yields [].
+    """
+    def safe_search(query):
+        try:
+            return search_fn(query)
+        except Exception as e:
+            logging.error(f'Error occurs when searching query {query}: {e}')
+            return []
+
+    if len(queries) <= 1 or max_threads <= 1:
+        return [safe_search(query) for query in queries]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_threads, len(queries))) as executor:
+        return list(executor.map(safe_search, queries))
+
+
+async def asearch_and_fetch(retriever, query_or_queries: Union[str, List[str]],
+                            result_filter: Optional[Callable[[Dict], bool]] = None) -> List[Dict]:
+    """
+    Async counterpart of the retrievers' forward: the searches run concurrently in worker threads (at most
+    retriever.search_max_threads at a time) and the result pages are downloaded and split by the
+    WebPageHelper's async pipeline, so a slow host only delays its own pages.
+
+    Args:
+        result_filter: Keeps only the search results it returns True for, before their pages are fetched,
+            like the source and exclude_urls checks of the retriever's forward.
+    """
+    queries = [query_or_queries] if isinstance(query_or_queries, str) else list(query_or_queries)
+    retriever.usage.add(len(queries))
+    limit = asyncio.Semaphore(max(1, retriever.search_max_threads))
+
+    async def safe_search(query):
+        async with limit:
+            try:
+                return await asyncio.to_thread(retriever._cached_search, query)
+            except Exception as e:
+                logging.error(f'Error occurs when searching query {query}: {e}')
+                return []
+
+    url_to_results = {}
+    for results in await asyncio.gather(*(safe_search(query) for query in queries)):
+        for result in results:
+            if result_filter is None or result_filter(result):
+                url_to_results[result['url']] = result
+
+    valid_url_to_snippets = await retriever.webpage_helper.aurls_to_snippets(list(url_to_results.keys()))
+    collected_results = []
+    for url in valid_url_to_snippets:
+        r = url_to_results[url]
+        r['snippets'] = valid_url_to_snippets[url]['snippets']
+        collected_results.append(r)
+    return collected_results
+
+
 class GoogleSearchAli(dspy.Retrieve):
     def __init__(self, bing_search_api_key=None, k=3, is_valid_source: Callable = None,
                  min_char_count: int = 150, snippet_chunk_size: int = 1000, webpage_helper_max_threads=10,
-                 mkt='en-US', language='en-US', **kwargs):
+                 mkt='en-US', language='en-US', page_cache_dir: Optional[str] = None,
+                 webpage_helper_extract_backend: str = 'inline', webpage_helper_extract_workers: Optional[int] = None,
+                 search_max_threads: int = 5, search_timeout: float = 10, search_max_retries: int = 3,
+                 search_cache_dir: Optional[str] = None,
+                 **kwargs):
 
         super().__init__(k=k)
         key = os.environ.get('SEARCHKEY', 'default_value')
@@ -30,8 +192,8 @@ class GoogleSearchAli(dspy.Retrieve):
             "Authorization": f"Bearer lm-/{key}== ",
         }
 
-        self.template = {
-            "rid": str(uuid.uuid4()),
+        # Shared by all threads and never mutated: each request builds its own copy in _search.
+        self._template = {
             "scene": "dolphin_search_bing_nlp",
             "uq": "",
             "debug": True,
@@ -54,9 +216,16 @@ class GoogleSearchAli(dspy.Retrieve):
         self.webpage_helper = WebPageHelper(
             min_char_count=min_char_count,
             snippet_chunk_size=snippet_chunk_size,
-            max_thread_num=webpage_helper_max_threads
+            max_thread_num=webpage_helper_max_threads,
+            cache_dir=page_cache_dir,
+            extract_backend=webpage_helper_extract_backend,
+            extract_workers=webpage_helper_extract_workers
         )
-        self.usage = 0
+        self.search_max_threads = search_max_threads
+        self.search_timeout = search_timeout
+        self.session = create_search_session(search_max_threads, search_max_retries)
+        self.search_cache = SearchCache(search_cache_dir, namespace='GoogleSearchAli') if search_cache_dir else None
+        self.usage = UsageCounter()
 
         # If not None, is_valid_source shall be a function that takes a URL and returns a boolean.
         if is_valid_source:
@@ -65,10 +234,32 @@ class GoogleSearchAli(dspy.Retrieve):
             self.is_valid_source = lambda x: True
 
     def get_usage_and_reset(self):
-        usage = self.usage
-        self.usage = 0
-
-        return {'BingSearch': usage}
+        usage = {'BingSearch': self.usage.get_and_reset()}
+        if self.search_cache is not None:
+            usage.update(self.search_cache.get_usage_and_reset())
+        return usage
+
+    def _cached_search(self, query: str) -> List[Dict]:
+        if self.search_cache is None:
+            return self._search(query)
+        return self.search_cache.search(query, self._search)
+
+    def _search(self, query: str) -> List[Dict]:
+        payload = copy.deepcopy(self._template)
+        payload["rid"] = str(uuid.uuid4())
+        payload["uq"] = query
+        response = self.session.post(
+            "https://nlp-cn-beijing.aliyuncs.com/gw/v1/api/msearch-sp/qwen-search",
+            data=json.dumps(payload),
+            headers=self.header,
+            timeout=self.search_timeout,
+        )
+        search_results = json.loads(response.text)['data']['docs']
+        return [{
+            'url': result['url'],
+            'title': result['title'],
+            'description': result.get('snippet', '')
+        } for result in search_results]
 
     def forward(self, query_or_queries: Union[str, List[str]], exclude_urls: List[str] = []):
 
@@ -77,29 +268,13 @@ class GoogleSearchAli(dspy.Retrieve):
             if isinstance(query_or_queries, str)
             else query_or_queries
         )
-        self.usage += len(queries)
+        self.usage.add(len(queries))
 
         url_to_results = {}
 
-        for query in queries:
-            try:
-                self.template["uq"] = query
-
-                response = requests.post(
-                    "https://nlp-cn-beijing.aliyuncs.com/gw/v1/api/msearch-sp/qwen-search",
-                    data=json.dumps(self.template),
-                    headers=self.header,
-                )              
-                response = json.loads(response.text)
-                search_results = response['data']['docs']
-                for result in search_results:
-                    url_to_results[result['url']] = {
-                        'url': result['url'],
-                        'title': result['title'],
-                        'description': result.get('snippet', '')
-                    }
-            except Exception as e:
-                logging.error(f'Error occurs when searching query {query}: {e}')
+        for results in search_concurrently(self._cached_search, queries, self.search_max_threads):
+            for result in results:
+                url_to_results[result['url']] = result
 
         valid_url_to_snippets = self.webpage_helper.urls_to_snippets(list(url_to_results.keys()))
         collected_results = []
@@ -110,17 +285,32 @@ class GoogleSearchAli(dspy.Retrieve):
 
         print(f'lengt of collected_results :{len(collected_results)}')
         return collected_results
-    
+
+    async def aforward(self, query_or_queries: Union[str, List[str]], exclude_urls: List[str] = []):
+        """Async variant of forward, returning the same results."""
+        return await asearch_and_fetch(self, query_or_queries)
+
 
 class BingSearchAli(dspy.Retrieve):
     def __init__(self, bing_search_api_key=None, k=3, is_valid_source: Callable = None,
                  min_char_count: int = 150, snippet_chunk_size: int = 1000, webpage_helper_max_threads=10,
-                 mkt='en-US', language='en-US', **kwargs):
+                 mkt='en-US', language='en-US', page_cache_dir: Optional[str] = None,
+                 webpage_helper_extract_backend: str = 'inline', webpage_helper_extract_workers: Optional[int] = None,
+                 search_max_threads: int = 5, search_timeout: float = 10, search_max_retries: int = 3,
+                 search_cache_dir: Optional[str] = None,
+                 **kwargs):
         """
         Params:
             min_char_count: Minimum character count for the article to be considered valid.
             snippet_chunk_size: Maximum character count for each snippet.
             webpage_helper_max_threads: Maximum number of threads to use for webpage helper.
+            page_cache_dir: If set, downloaded webpages are cached on disk there and reused across runs.
+            webpage_helper_extract_backend: 'inline' or 'process'; 'process' extracts pages in a process pool.
+            webpage_helper_extract_workers: Number of extraction processes for the 'process' backend.
+            search_max_threads: Maximum number of search queries issued concurrently.
+            search_timeout: Timeout in seconds of each search request.
+            search_max_retries: Number of retries, with exponential backoff, of a failed search request.
+            search_cache_dir: If set, search results are cached on disk there, keyed by normalized query.
             mkt, language, **kwargs: Bing search API parameters.
             - Reference: https://learn.microsoft.com/en-us/bing/search-apis/bing-web-search/reference/query-parameters
         """
@@ -143,9 +333,16 @@ class BingSearchAli(dspy.Retrieve):
         self.webpage_helper = WebPageHelper(
             min_char_count=min_char_count,
             snippet_chunk_size=snippet_chunk_size,
-            max_thread_num=webpage_helper_max_threads
+            max_thread_num=webpage_helper_max_threads,
+            cache_dir=page_cache_dir,
+            extract_backend=webpage_helper_extract_backend,
+            extract_workers=webpage_helper_extract_workers
         )
-        self.usage = 0
+        self.search_max_threads = search_max_threads
+        self.search_timeout = search_timeout
+        self.session = create_search_session(search_max_threads, search_max_retries)
+        self.search_cache = SearchCache(search_cache_dir, namespace=f'BingSearchAli:{k}') if search_cache_dir else None
+        self.usage = UsageCounter()
 
         # If not None, is_valid_source shall be a function that takes a URL and returns a boolean.
         if is_valid_source:
@@ -154,10 +351,44 @@ class BingSearchAli(dspy.Retrieve):
             self.is_valid_source = lambda x: True
 
     def get_usage_and_reset(self):
-        usage = self.usage
-        self.usage = 0
-
-        return {'BingSearch': usage}
+        usage = {'BingSearch': self.usage.get_and_reset()}
+        if self.search_cache is not None:
+            usage.update(self.search_cache.get_usage_and_reset())
+        return usage
+
+    def _cached_search(self, query: str) -> List[Dict]:
+        if self.search_cache is None:
+            return self._search(query)
+        return self.search_cache.search(query, self._search)
+
+    def _search(self, query: str) -> List[Dict]:
+        payload = {
+            "query": query,
+            "num": self.count,
+            "extendParams": {
+                "country": "US",
+                "locale": "en-US",
+                "location": "United States",
+                "page": 2
+            },
+            "platformInput": {
+                "model": "google-search",
+                "instanceVersion": "S1"
+            }
+        }
+        header = {"X-AK": self.bing_api_key, "Content-Type": "application/json"}
+        response = self.session.post(
+            self.endpoint,
+            headers=header,
+            json=payload,
+            timeout=self.search_timeout,
+        ).json()
+        search_results = response['data']['originalOutput']['webPages']['value']
+        return [{
+            'url': result['url'],
+            'title': result['name'],
+            'description': result.get('snippet', '')
+        } for result in search_results]
 
     def forward(self, query_or_queries: Union[str, List[str]], exclude_urls: List[str] = []):
         """Search with Bing for self.k top passages for query or queries
@@ -174,44 +405,13 @@ class BingSearchAli(dspy.Retrieve):
             if isinstance(query_or_queries, str)
             else query_or_queries
         )
-        self.usage += len(queries)
+        self.usage.add(len(queries))
 
         url_to_results = {}
 
-        payload_template = {
-            "query": "pleaceholder",
-            "num": self.count,
-            "extendParams": {
-                "country": "US",
-                "locale": "en-US",
-                "location": "United States",
-                "page": 2
-            },
-            "platformInput": {
-                "model": "google-search",
-                "instanceVersion": "S1"
-            }
-        }
-        header = {"X-AK": self.bing_api_key, "Content-Type": "application/json"}
-
-        for query in queries:
-            try:
-                payload_template["query"] = query
-                response = requests.post(
-                    self.endpoint,
-                    headers=header,
-                    json=payload_template,
-                ).json()
-                search_results = response['data']['originalOutput']['webPages']['value']
-
-                for result in search_results:
-                    url_to_results[result['url']] = {
-                        'url': result['url'],
-                        'title': result['name'],
-                        'description': result.get('snippet', '')
-                    }
-            except Exception as e:
-                logging.error(f'Error occurs when searching query {query}: {e}')
+        for results in search_concurrently(self._cached_search, queries, self.search_max_threads):
+            for result in results:
+                url_to_results[result['url']] = result
 
         valid_url_to_snippets = self.webpage_helper.urls_to_snippets(list(url_to_results.keys()))
         collected_results = []
@@ -221,16 +421,31 @@ class BingSearchAli(dspy.Retrieve):
             collected_results.append(r)
         return collected_results
 
+    async def aforward(self, query_or_queries: Union[str, List[str]], exclude_urls: List[str] = []):
+        """Async variant of forward, returning the same results."""
+        return await asearch_and_fetch(self, query_or_queries)
+
 
 class BingSearch(dspy.Retrieve):
     def __init__(self, bing_search_api_key=None, k=3, is_valid_source: Callable = None,
                  min_char_count: int = 150, snippet_chunk_size: int = 1000, webpage_helper_max_threads=10,
-                 mkt='en-US', language='en', **kwargs):
+                 mkt='en-US', language='en', page_cache_dir: Optional[str] = None,
+                 webpage_helper_extract_backend: str = 'inline', webpage_helper_extract_workers: Optional[int] = None,
+                 search_max_threads: int = 5, search_timeout: float = 10, search_max_retries: int = 3,
+                 search_cache_dir: Optional[str] = None,
+                 **kwargs):
         """
         Params:
             min_char_count: Minimum character count for the article to be considered valid.
             snippet_chunk_size: Maximum character count for each snippet.
             webpage_helper_max_threads: Maximum number of threads to use for webpage helper.
+            page_cache_dir: If set, downloaded webpages are cached on disk there and reused across runs.
+            webpage_helper_extract_backend: 'inline' or 'process'; 'process' extracts pages in a process pool.
+            webpage_helper_extract_workers: Number of extraction processes for the 'process' backend.
+            search_max_threads: Maximum number of search queries issued concurrently.
+            search_timeout: Timeout in seconds of each search request.
+            search_max_retries: Number of retries, with exponential backoff, of a failed search request.
+            search_cache_dir: If set, search results are cached on disk there, keyed by normalized query.
             mkt, language, **kwargs: Bing search API parameters.
             - Reference: https://learn.microsoft.com/en-us/bing/search-apis/bing-web-search/reference/query-parameters
         """
@@ -252,9 +467,18 @@ class BingSearch(dspy.Retrieve):
         self.webpage_helper = WebPageHelper(
             min_char_count=min_char_count,
             snippet_chunk_size=snippet_chunk_size,
-            max_thread_num=webpage_helper_max_threads
+            max_thread_num=webpage_helper_max_threads,
+            cache_dir=page_cache_dir,
+            extract_backend=webpage_helper_extract_backend,
+            extract_workers=webpage_helper_extract_workers
         )
-        self.usage = 0
+        self.search_max_threads = search_max_threads
+        self.search_timeout = search_timeout
+        self.session = create_search_session(search_max_threads, search_max_retries)
+        self.search_cache = SearchCache(
+            search_cache_dir, namespace=f'BingSearch:{json.dumps(self.params, sort_keys=True)}'
+        ) if search_cache_dir else None
+        self.usage = UsageCounter()
 
         # If not None, is_valid_source shall be a function that takes a URL and returns a boolean.
         if is_valid_source:
@@ -263,10 +487,25 @@ class BingSearch(dspy.Retrieve):
             self.is_valid_source = lambda x: True
 
     def get_usage_and_reset(self):
-        usage = self.usage
-        self.usage = 0
+        usage = {'BingSearch': self.usage.get_and_reset()}
+        if self.search_cache is not None:
+            usage.update(self.search_cache.get_usage_and_reset())
+        return usage
+
+    def _cached_search(self, query: str) -> List[Dict]:
+        if self.search_cache is None:
+            return self._search(query)
+        return self.search_cache.search(query, self._search)
 
-        return {'BingSearch': usage}
+    def _search(self, query: str) -> List[Dict]:
+        headers = {"Ocp-Apim-Subscription-Key": self.bing_api_key , "Content-Type": "application/json" }
+        results = self.session.get(
+            self.endpoint,
+            headers=headers,
+            params={**self.params, 'q': query},
+            timeout=self.search_timeout,
+        ).json()
+        return [{'url': d['url'], 'title': d['name'], 'description': d['snippet']} for d in results['webPages']['value']]
 
     def forward(self, query_or_queries: Union[str, List[str]], exclude_urls: List[str] = []):
         """Search with Bing for self.k top passages for query or queries
@@ -283,25 +522,14 @@ class BingSearch(dspy.Retrieve):
             if isinstance(query_or_queries, str)
             else query_or_queries
         )
-        self.usage += len(queries)
+        self.usage.add(len(queries))
 
         url_to_results = {}
 
-        headers = {"Ocp-Apim-Subscription-Key": self.bing_api_key , "Content-Type": "application/json" }
-
-        for query in queries:
-            try:
-                results = requests.get(
-                    self.endpoint,
-                    headers=headers,
-                    params={**self.params, 'q': query}
-                ).json()
-
-                for d in results['webPages']['value']:
-                    if self.is_valid_source(d['url']) and d['url'] not in exclude_urls:
-                        url_to_results[d['url']] = {'url': d['url'], 'title': d['name'], 'description': d['snippet']}
-            except Exception as e:
-                logging.error(f'Error occurs when searching query {query}: {e}')
+        for results in search_concurrently(self._cached_search, queries, self.search_max_threads):
+            for d in results:
+                if self.is_valid_source(d['url']) and d['url'] not in exclude_urls:
+                    url_to_results[d['url']] = d
 
         valid_url_to_snippets = self.webpage_helper.urls_to_snippets(list(url_to_results.keys()))
         collected_results = []
@@ -311,3 +539,8 @@ class BingSearch(dspy.Retrieve):
             collected_results.append(r)
         return collected_results
 
+    async def aforward(self, query_or_queries: Union[str, List[str]], exclude_urls: List[str] = []):
+        """Async variant of forward, returning the same results."""
+        return await asearch_and_fetch(
+            self, query_or_queries,
+            result_filter=lambda d: self.is_valid_source(d['url']) and d['url'] not in exclude_urls)
@@ -22,22 +22,21 @@ class ArticleTextProcessing:
             str: The truncated string with word count limited to `max_word_count`, preserving complete lines.
         """
 
-        word_count = 0
-        limited_string = ''
-
-        for word in input_string.split('\n'):
-            line_words = word.split()
-            for lw in line_words:
-                if word_count < max_word_count:
-                    limited_string += lw + ' '
-                    word_count += 1
-                else:
-                    break
-            if word_count >= max_word_count:
+        # Collect the kept lines and join once: building the result with += and re-stripping it after every
+        # line is quadratic in the length of the input.
+        limited_lines = []
+        remaining = max_word_count
+
+        for line in input_string.split('\n'):
+            if remaining <= 0:
                 break
-            limited_string = limited_string.strip() + '\n'
+            # Split off at most the words still allowed; the rest of the line stays one unsplit string.
+            line_words = line.split(None, remaining)[:remaining]
+            if line_words:
+                limited_lines.append(' '.join(line_words))
+                remaining -= len(line_words)
 
-        return limited_string.strip()
+        return '\n'.join(limited_lines)
 
     @staticmethod
     def remove_citations(s):
@@ -0,0 +1,63 @@
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from typing import Any
+
+
+def atomic_write(path: str, data: bytes):
+    """Write data to path so that a crash leaves either the previous file or the complete new one."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class Checkpoint:
+    """
+    The checkpoint files of one run, stored under `directory` by name (names may contain sub-directories).
+    Every write is atomic.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def has(self, name: str) -> bool:
+        return os.path.exists(self.path(name))
+
+    def save_json(self, name: str, obj: Any):
+        atomic_write(self.path(name), json.dumps(obj, ensure_ascii=False).encode('utf-8'))
+
+    def load_json(self, name: str, default: Any = None) -> Any:
+        if not self.has(name):
+            return default
+        with open(self.path(name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_pickle(self, name: str, obj: Any):
+        atomic_write(self.path(name), pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def load_pickle(self, name: str, default: Any = None) -> Any:
+        if not self.has(name):
+            return default
+        with open(self.path(name), 'rb') as f:
+            return pickle.load(f)
+
+    def clear(self):
+        """Remove every checkpoint of this run."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
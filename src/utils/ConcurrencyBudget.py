@@ -0,0 +1,58 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+from typing import Callable, Optional
+
+
+class ConcurrencyBudget:
+    """
+    Global limits on the number of in-flight operations of each kind (e.g. 'llm', 'search', 'encode'), shared by
+    every coroutine of one or more pipelines running on the same event loop.
+
+    Blocking work is run through `run`, which waits for a slot of its kind and then executes the call on the
+    budget's own thread pool, so independent LM calls and searches overlap while the totals stay bounded.
+    Kinds without a limit are only bounded by the size of the thread pool.
+    """
+
+    DEFAULT_LIMITS = {'llm': 8, 'search': 5, 'encode': 1}
+
+    def __init__(self, max_threads: Optional[int] = None, **limits: int):
+        """
+        Args:
+            max_threads: Size of the thread pool running blocking calls. Defaults to the sum of the limits.
+            **limits: Maximum number of concurrent operations per kind, e.g. llm=8, search=5. Kinds not given
+                keep their DEFAULT_LIMITS value.
+        """
+        self.limits = {**self.DEFAULT_LIMITS, **limits}
+        self.max_threads = max_threads or sum(self.limits.values())
+        self._semaphores = {}
+        self._executor = None
+
+    def limit(self, kind: str):
+        """An async context manager holding one slot of `kind` while it is entered."""
+        if kind not in self.limits:
+            return contextlib.nullcontext()
+        # Created lazily so that the semaphores belong to the loop running the pipeline.
+        if kind not in self._semaphores:
+            self._semaphores[kind] = asyncio.Semaphore(self.limits[kind])
+        return self._semaphores[kind]
+
+    def get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads,
+                                                                   thread_name_prefix='budget')
+        return self._executor
+
+    async def run(self, kind: str, fn: Callable, *args, **kwargs):
+        """Run the blocking fn(*args, **kwargs) in a worker thread once a slot of `kind` is free."""
+        # Copy the context so that context variables such as the usage stage follow the call into the thread.
+        call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        async with self.limit(kind):
+            return await asyncio.get_running_loop().run_in_executor(self.get_executor(), call)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
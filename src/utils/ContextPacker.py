@@ -0,0 +1,164 @@
+import functools
+import math
+import re
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.utils.RateLimiter import estimate_tokens
+from src.utils.UsageTracker import UsageTracker, current_stage, usage_tracker
+
+try:
+    import tiktoken
+except ImportError:  # Fall back to the estimate used for rate limiting.
+    tiktoken = None
+
+# Hugging Face tokenizers of the model families tiktoken does not know, by model name prefix. All Qwen2 and
+# Qwen2.5 models, including those served by DashScope, share one tokenizer.
+HF_TOKENIZERS = {
+    'qwen': 'Qwen/Qwen2.5-7B-Instruct',
+}
+
+# Context windows in tokens, by model name prefix; the longest matching prefix wins.
+CONTEXT_WINDOWS = {
+    'qwen-max': 32768,
+    'qwen-plus': 131072,
+    'qwen-turbo': 131072,
+    'qwen2.5': 131072,
+    'gpt-3.5-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 32768
+
+_TERM = re.compile(r'[a-z0-9]+|[\u3040-\u30ff\u4e00-\u9fff\uac00-\ud7af]')
+
+
+def _match_prefix(table: Dict[str, object], model: Optional[str]):
+    """Value of the longest key of table that model's name starts with, or None."""
+    if not model:
+        return None
+    model = model.lower()
+    matches = [prefix for prefix in table if model.startswith(prefix)]
+    return table[max(matches, key=len)] if matches else None
+
+
+def _hf_token_counter(name: str) -> Optional[Callable[[str], int]]:
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(name)
+    except Exception as e:  # transformers missing, or the tokenizer cannot be downloaded
+        print(f'Could not load the tokenizer {name}, counting tokens with tiktoken instead: {e!r}')
+        return None
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_counter(model: Optional[str] = None) -> Callable[[str], int]:
+    """
+    Token counter for model: the Hugging Face tokenizer of its family if listed in HF_TOKENIZERS, else its
+    tiktoken encoding (cl100k_base for models tiktoken does not know), or estimate_tokens if neither can be
+    loaded.
+    """
+    hf_name = _match_prefix(HF_TOKENIZERS, model)
+    if hf_name is not None:
+        counter = _hf_token_counter(hf_name)
+        if counter is not None:
+            return counter
+    if tiktoken is None:
+        return estimate_tokens
+    try:
+        encoding = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding('cl100k_base')
+    except KeyError:
+        encoding = tiktoken.get_encoding('cl100k_base')
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def context_budget(lm, share: float) -> int:
+    """
+    Token budget for the snippets of a prompt to lm: share of its model's context window, after the room
+    reserved for its completion (max_tokens).
+    """
+    window = _match_prefix(CONTEXT_WINDOWS, getattr(lm, 'model', None)) or DEFAULT_CONTEXT_WINDOW
+    max_tokens = getattr(lm, 'max_tokens', None) or getattr(lm, 'kwargs', {}).get('max_tokens', 0)
+    return max(0, int(share * (window - max_tokens)))
+
+
+def _terms(text: str) -> List[str]:
+    """Lower-cased words, and single characters of CJK text, which has no spaces to split words on."""
+    return _TERM.findall(text.lower())
+
+
+def rank_by_relevance(texts: List[str], query: str, k1: float = 1.2, b: float = 0.75) -> List[int]:
+    """Indices of texts, most relevant to query first by BM25 over the texts themselves; ties keep their order."""
+    query_terms = set(_terms(query))
+    if not query_terms or not texts:
+        return list(range(len(texts)))
+    term_counts = [Counter(_terms(text)) for text in texts]
+    lengths = [sum(counts.values()) for counts in term_counts]
+    average_length = sum(lengths) / len(lengths) or 1
+    document_frequency = Counter(term for counts in term_counts for term in query_terms if term in counts)
+
+    def score(i: int) -> float:
+        total = 0.0
+        for term in query_terms:
+            tf = term_counts[i].get(term, 0)
+            if tf:
+                idf = math.log(1 + (len(texts) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+                total += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[i] / average_length))
+        return total
+
+    scores = [score(i) for i in range(len(texts))]
+    return sorted(range(len(texts)), key=lambda i: (-scores[i], i))
+
+
+class ContextPacker:
+    """
+    Chooses which snippets go into a prompt under a token budget: snippets are ranked by relevance to the
+    query (e.g. the section or category being written about) and added greedily, most relevant first,
+    skipping those that no longer fit. The tokens of what was left out are recorded on the usage tracker.
+    """
+
+    def __init__(self, max_tokens: int, model: Optional[str] = None, stage: Optional[str] = None,
+                 tracker: Optional[UsageTracker] = None):
+        """
+        Args:
+            max_tokens: Token budget of the packed snippets.
+            model: Model the prompt is for, whose tokenizer counts the tokens.
+            stage: Stage the savings are recorded under; the current usage stage if None.
+            tracker: Tracker the savings are recorded on, the shared usage_tracker by default.
+        """
+        self.max_tokens = max_tokens
+        self.count_tokens = get_token_counter(model)
+        self.stage = stage
+        self.tracker = tracker or usage_tracker
+
+    def pack(self, texts: List[str], query: str = '', groups: Optional[List] = None,
+             group_overhead: int = 0) -> Tuple[List[int], int, int]:
+        """
+        Args:
+            texts: The snippets, each costing its tokens plus one for the separator.
+            query: Text the snippets are ranked against. They keep their order if empty.
+            groups: Group of every snippet, e.g. the source it is listed under. The first snippet selected from
+                a group also costs group_overhead tokens, for the group's header.
+
+        Returns:
+            (indices of the selected texts in their original order, tokens of all the texts, tokens selected)
+        """
+        costs = [self.count_tokens(text) + 1 for text in texts]
+        total = sum(costs) + group_overhead * len(set(groups or ()))
+        used = 0
+        selected = []
+        opened = set()
+        for i in rank_by_relevance(texts, query):
+            cost = costs[i]
+            if groups is not None and groups[i] not in opened:
+                cost += group_overhead
+            if used + cost > self.max_tokens:
+                continue
+            used += cost
+            selected.append(i)
+            if groups is not None:
+                opened.add(groups[i])
+        self.tracker.record_packing(total, used, stage=self.stage or current_stage())
+        return sorted(selected), total, used
@@ -0,0 +1,104 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Optional
+
+
+class DiskCache:
+    """
+    Persistent key-value cache backed by a SQLite table.
+
+    Values are pickled and zlib-compressed. Each thread gets its own connection and the database runs in WAL
+    mode, so one cache file can be shared by many threads and processes. Entries older than `ttl` seconds are
+    treated as missing and evicted; when `max_entries` is set the least recently used entries are evicted
+    beyond that size.
+    """
+
+    def __init__(self, path: str, table: str = 'cache', ttl: Optional[float] = None,
+                 max_entries: Optional[int] = None, evict_every: int = 100):
+        """
+        Args:
+            path: SQLite database file. Several caches may share a file by using different tables.
+            table: Table holding this cache's entries.
+            ttl: Time to live of an entry in seconds. None keeps entries until they are evicted by size.
+            max_entries: Maximum number of entries kept, evicting the least recently used ones.
+            evict_every: Run eviction after this many writes.
+        """
+        if not table.isidentifier():
+            raise ValueError(f'Invalid cache table name {table!r}')
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._writes = 0
+        self._local = threading.local()
+        self._count_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {table} ('
+                         'key TEXT PRIMARY KEY, value BLOB, created_at REAL, accessed_at REAL)')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_accessed_at ON {table} (accessed_at)')
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def get(self, key: str, default: Any = None) -> Any:
+        conn = self._connection()
+        row = conn.execute(f'SELECT value, created_at FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        if row is None or self._expired(row[1]):
+            return default
+        if self.max_entries is not None:
+            with conn:
+                conn.execute(f'UPDATE {self.table} SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def set(self, key: str, value: Any):
+        now = time.time()
+        blob = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        with self._connection() as conn:
+            conn.execute(f'INSERT OR REPLACE INTO {self.table} (key, value, created_at, accessed_at) '
+                         'VALUES (?, ?, ?, ?)', (key, sqlite3.Binary(blob), now, now))
+        with self._count_lock:
+            self._writes += 1
+            evict = self._writes % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def delete(self, key: str):
+        with self._connection() as conn:
+            conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+    def __contains__(self, key: str) -> bool:
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def __len__(self) -> int:
+        return self._connection().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones beyond max_entries."""
+        with self._connection() as conn:
+            if self.ttl is not None:
+                conn.execute(f'DELETE FROM {self.table} WHERE created_at < ?', (time.time() - self.ttl,))
+            if self.max_entries is not None:
+                conn.execute(f'DELETE FROM {self.table} WHERE key IN ('
+                             f'SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                             (self.max_entries,))
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute(f'DELETE FROM {self.table}')
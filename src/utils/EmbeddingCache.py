@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Callable, List, Sequence
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only.
+    fcntl = None
+
+
+class EmbeddingCache:
+    """
+    Content-addressed on-disk cache of text embeddings.
+
+    Each entry is keyed by sha1(model name, text). Vectors are appended to a flat binary file that is read
+    back through np.memmap, and an append-only index file maps keys to rows, so the cache can be shared by
+    several runs (and processes) encoding with the same model.
+
+    Layout of cache_dir:
+        meta.json       model name, embedding dimension and dtype
+        embeddings.bin  row-major matrix of embeddings
+        index.txt       one "<key> <row>" line per cached embedding
+    """
+
+    def __init__(self, cache_dir: str, model_name: str, dtype: str = 'float16'):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.dtype = np.dtype(dtype)
+        self.dim = None
+        self._rows = {}
+        self._index_offset = 0
+        self._mmap = None
+        self._lock = threading.Lock()
+        self._meta_path = os.path.join(cache_dir, 'meta.json')
+        self._data_path = os.path.join(cache_dir, 'embeddings.bin')
+        self._index_path = os.path.join(cache_dir, 'index.txt')
+        self._lock_path = os.path.join(cache_dir, 'lock')
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._lock:
+            self._refresh()
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(f'{self.model_name}\0{text}'.encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, text: str):
+        return self.key(text) in self._rows
+
+    def _file_lock(self):
+        return _FileLock(self._lock_path)
+
+    def _refresh(self):
+        """Pick up rows appended since the last read, possibly by another process."""
+        if self.dim is None and os.path.exists(self._meta_path):
+            with open(self._meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta['model'] != self.model_name or np.dtype(meta['dtype']) != self.dtype:
+                raise ValueError(f'Embedding cache at {self.cache_dir} was written for {meta["model"]} '
+                                 f'({meta["dtype"]}), not {self.model_name} ({self.dtype})')
+            self.dim = meta['dim']
+        if not os.path.exists(self._index_path):
+            return
+        with open(self._index_path, 'r', encoding='utf-8') as f:
+            f.seek(self._index_offset)
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # partially written line, retry on the next refresh
+                key, row = line.split()
+                self._rows[key] = int(row)
+                self._index_offset += len(line.encode('utf-8'))
+        self._mmap = None
+
+    def _matrix(self) -> np.ndarray:
+        if self._mmap is None:
+            num_rows = os.path.getsize(self._data_path) // (self.dim * self.dtype.itemsize)
+            self._mmap = np.memmap(self._data_path, dtype=self.dtype, mode='r', shape=(num_rows, self.dim))
+        return self._mmap
+
+    def _lookup(self, keys: Sequence[str]):
+        matrix = self._matrix() if self._rows else None
+        return {k: np.asarray(matrix[self._rows[k]], dtype=np.float32) for k in keys if k in self._rows}
+
+    def _append(self, keys: List[str], embeddings: np.ndarray):
+        embeddings = np.asarray(embeddings).astype(self.dtype)
+        with self._file_lock():
+            self._refresh()
+            if self.dim is None:
+                self.dim = int(embeddings.shape[1])
+                with open(self._meta_path, 'w', encoding='utf-8') as f:
+                    json.dump({'model': self.model_name, 'dim': self.dim, 'dtype': self.dtype.name}, f)
+            keep = [i for i, k in enumerate(keys) if k not in self._rows]
+            if not keep:
+                return
+            # Rows are derived from the data file size so that a crash between the two writes below can only
+            # leave unreferenced bytes behind, never an index line pointing at the wrong vector. A torn partial
+            # row left by such a crash is cut off first, so that the new rows start where first_row says.
+            row_bytes = self.dim * self.dtype.itemsize
+            with open(self._data_path, 'r+b' if os.path.exists(self._data_path) else 'w+b') as f:
+                first_row = os.fstat(f.fileno()).st_size // row_bytes
+                f.truncate(first_row * row_bytes)
+                f.seek(first_row * row_bytes)
+                f.write(np.ascontiguousarray(embeddings[keep]).tobytes())
+            with open(self._index_path, 'a', encoding='utf-8') as f:
+                f.write(''.join(f'{keys[i]} {first_row + n}\n' for n, i in enumerate(keep)))
+            self._refresh()
+
+    def encode(self, texts: Sequence[str], encode_fn: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """
+        Return the embeddings of texts, calling encode_fn only on texts that are not cached yet.
+
+        Args:
+            texts: Texts to embed.
+            encode_fn: Function embedding a list of texts into an (n, dim) array, e.g. SentenceTransformer.encode.
+
+        Returns:
+            float32 array of shape (len(texts), dim).
+        """
+        keys = [self.key(t) for t in texts]
+        with self._lock:
+            found = self._lookup(set(keys))
+            if len(found) < len(set(keys)):
+                self._refresh()
+                found = self._lookup(set(keys))
+
+        missing = {}
+        for k, t in zip(keys, texts):
+            if k not in found and k not in missing:
+                missing[k] = t
+        if missing:
+            new_embeddings = np.asarray(encode_fn(list(missing.values())))
+            with self._lock:
+                self._append(list(missing.keys()), new_embeddings)
+            for k, e in zip(missing.keys(), new_embeddings):
+                found[k] = np.asarray(e, dtype=np.float32)
+
+        if not keys:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.stack([found[k] for k in keys])
+
+
+class _FileLock:
+    """Exclusive advisory lock on a file, used to serialize appends across processes."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._f = None
+
+    def __enter__(self):
+        self._f = open(self.path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+        self._f = None
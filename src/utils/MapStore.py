@@ -0,0 +1,192 @@
+import io
+import json
+import zipfile
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src.utils.Checkpoint import atomic_write
+from src.utils.VectorIndex import create_index
+
+FORMAT_VERSION = 1
+
+
+def _pack_strings(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Pack strings into one UTF-8 byte column plus the offsets delimiting each of them."""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    if encoded:
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+class _StringColumn:
+    """Read side of _pack_strings: strings are only decoded when accessed."""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data.tobytes()
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+
+class _Interner:
+    """Assigns consecutive ids to distinct values."""
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def __call__(self, value) -> int:
+        if value not in self.ids:
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+        return self.ids[value]
+
+
+def save_compact_map(filename: str, nodes: List[Dict], index=None,
+                     table_urls: Optional[List[str]] = None, table_snippets: Optional[List[str]] = None,
+                     table_duplicate_urls: Optional[Dict[int, List[str]]] = None):
+    """
+    Save a mind map in the compact format: a compressed .npz of columns.
+
+    Every distinct URL, snippet and info record is stored once and nodes refer to their info by id, so a page
+    retrieved by many nodes costs its text only once. The retrieval table and its vector index, if given, are
+    stored in the same file.
+
+    Args:
+        nodes: The nodes in pre-order, each {'parent': index of the parent node or -1 for the root,
+            'category': str, 'concept': list of str, 'novelty': float, 'info': [{'url': ..., 'snippets': [...]}]}.
+        index: The vector index over the retrieval table.
+        table_urls, table_snippets: The retrieval table, one URL and one snippet per row of the index.
+        table_duplicate_urls: Row of the retrieval table -> other URLs whose near-duplicate snippet it stands for.
+    """
+    urls, snippets, infos = _Interner(), _Interner(), _Interner()
+    node_info_offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    node_info_ids = []
+    for i, node in enumerate(nodes):
+        for info in node['info']:
+            extra = {k: v for k, v in info.items() if k not in ('url', 'snippets')}
+            node_info_ids.append(infos((urls(info.get('url', '')),
+                                        tuple(snippets(s) for s in info.get('snippets', [])),
+                                        json.dumps(extra, ensure_ascii=False, sort_keys=True))))
+        node_info_offsets[i + 1] = len(node_info_ids)
+
+    info_snippet_offsets = np.zeros(len(infos.values) + 1, dtype=np.int64)
+    if infos.values:
+        np.cumsum([len(info[1]) for info in infos.values], out=info_snippet_offsets[1:])
+
+    columns = {
+        'node_parent': np.array([node['parent'] for node in nodes], dtype=np.int32),
+        'node_novelty': np.array([node.get('novelty', 1.0) for node in nodes], dtype=np.float32),
+        'node_info_offsets': node_info_offsets,
+        'node_info_ids': np.array(node_info_ids, dtype=np.int32),
+        'info_url': np.array([info[0] for info in infos.values], dtype=np.int32),
+        'info_snippet_offsets': info_snippet_offsets,
+        'info_snippet_ids': np.array([s for info in infos.values for s in info[1]], dtype=np.int32),
+    }
+    string_columns = {
+        'node_category': [node['category'] for node in nodes],
+        'node_concept': [json.dumps(node['concept'], ensure_ascii=False) for node in nodes],
+        'info_extra': [info[2] for info in infos.values],
+    }
+
+    meta = {'format_version': FORMAT_VERSION, 'index_type': None}
+    if index is not None:
+        meta['index_type'] = index.index_type
+        columns.update({f'index_{k}': v for k, v in index.state_dict().items()})
+        columns['table_url'] = np.array([urls(url) for url in table_urls], dtype=np.int32)
+        columns['table_snippet'] = np.array([snippets(s) for s in table_snippets], dtype=np.int32)
+        duplicate_urls = table_duplicate_urls or {}
+        rows = [duplicate_urls.get(row, []) for row in range(len(table_urls))]
+        columns['table_duplicate_offsets'] = np.zeros(len(rows) + 1, dtype=np.int64)
+        if rows:
+            np.cumsum([len(urls_of_row) for urls_of_row in rows], out=columns['table_duplicate_offsets'][1:])
+        columns['table_duplicate_url'] = np.array([urls(url) for urls_of_row in rows for url in urls_of_row],
+                                                  dtype=np.int32)
+    # After the table, which may have added URLs and snippets of its own.
+    string_columns['url'] = urls.values
+    string_columns['snippet'] = snippets.values
+
+    for name, strings in string_columns.items():
+        columns[f'{name}_data'], columns[f'{name}_offsets'] = _pack_strings(strings)
+    columns['meta'] = np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8)
+
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **columns)
+    atomic_write(filename, buffer.getvalue())
+
+
+def is_compact_map(filename: str) -> bool:
+    """Whether filename holds a map saved by save_compact_map rather than a JSON one."""
+    return zipfile.is_zipfile(filename)
+
+
+class CompactMapReader:
+    """
+    Reads a map saved by save_compact_map. The node structure is available right away; the info of a node
+    is only decoded by node_infos, when it is first needed. Info records shared by several nodes are decoded
+    once and shared.
+    """
+
+    def __init__(self, filename: str):
+        with np.load(filename, allow_pickle=False) as data:
+            self.meta = json.loads(data['meta'].tobytes().decode('utf-8'))
+            columns = {k: data[k] for k in data.files if k != 'meta'}
+        self.parents = columns['node_parent']
+        self.novelties = columns['node_novelty']
+        self.node_info_offsets = columns['node_info_offsets']
+        self.node_info_ids = columns['node_info_ids']
+        self.info_url = columns['info_url']
+        self.info_snippet_offsets = columns['info_snippet_offsets']
+        self.info_snippet_ids = columns['info_snippet_ids']
+        self.categories, self.concepts, self.info_extras, self.urls, self.snippets = (
+            _StringColumn(columns[f'{name}_data'], columns[f'{name}_offsets'])
+            for name in ('node_category', 'node_concept', 'info_extra', 'url', 'snippet'))
+        self._index_state = {k[len('index_'):]: v for k, v in columns.items() if k.startswith('index_')}
+        self._table_url = columns.get('table_url')
+        self._table_snippet = columns.get('table_snippet')
+        self._table_duplicate_offsets = columns.get('table_duplicate_offsets')
+        self._table_duplicate_url = columns.get('table_duplicate_url')
+        self._infos = {}
+
+    def __len__(self):
+        return len(self.parents)
+
+    def category(self, node: int) -> str:
+        return self.categories[node]
+
+    def concept(self, node: int) -> List[str]:
+        return json.loads(self.concepts[node])
+
+    def info(self, info_id: int) -> Dict:
+        if info_id not in self._infos:
+            start, end = self.info_snippet_offsets[info_id], self.info_snippet_offsets[info_id + 1]
+            info = {'url': self.urls[self.info_url[info_id]],
+                    'snippets': [self.snippets[s] for s in self.info_snippet_ids[start:end]]}
+            info.update(json.loads(self.info_extras[info_id]))
+            self._infos[info_id] = info
+        return self._infos[info_id]
+
+    def node_infos(self, node: int) -> List[Dict]:
+        start, end = self.node_info_offsets[node], self.node_info_offsets[node + 1]
+        return [self.info(info_id) for info_id in self.node_info_ids[start:end]]
+
+    def has_retrieval_table(self) -> bool:
+        return self.meta['index_type'] is not None
+
+    def retrieval_table(self) -> Tuple[List[str], List[str], object, Dict[int, List[str]]]:
+        """The retrieval table saved with the map, as (urls, snippets, index, duplicate_urls)."""
+        index = create_index(self.meta['index_type']).load_state_dict(self._index_state)
+        duplicate_urls = {}
+        if self._table_duplicate_offsets is not None:
+            offsets = self._table_duplicate_offsets
+            for row in np.flatnonzero(np.diff(offsets)):
+                row_urls = self._table_duplicate_url[offsets[row]:offsets[row + 1]]
+                duplicate_urls[int(row)] = [self.urls[i] for i in row_urls]
+        return ([self.urls[i] for i in self._table_url], [self.snippets[i] for i in self._table_snippet], index,
+                duplicate_urls)
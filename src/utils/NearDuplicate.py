@@ -0,0 +1,88 @@
+import re
+import zlib
+from typing import List, Optional
+
+import numpy as np
+
+# A prime just above 2**32: with 32-bit shingle hashes and coefficients, a * x + b fits in 64 bits.
+_PRIME = np.uint64(4294967311)
+
+
+def shingles(text: str, size: int = 5) -> np.ndarray:
+    """
+    Hashes of the character `size`-grams of text, lower-cased and with whitespace collapsed. Character
+    n-grams work the same for space-separated and CJK text.
+    """
+    text = re.sub(r'\s+', ' ', text.lower()).strip()
+    if len(text) <= size:
+        return np.array([zlib.crc32(text.encode('utf-8'))], dtype=np.uint64)
+    return np.unique(np.array([zlib.crc32(text[i:i + size].encode('utf-8')) for i in range(len(text) - size + 1)],
+                              dtype=np.uint64))
+
+
+class NearDuplicateIndex:
+    """
+    MinHash index that finds, among the texts added so far, one whose shingle Jaccard similarity with a new
+    text reaches `threshold`. Candidates come from locality-sensitive hashing of the signatures in `bands`
+    bands, and are confirmed on the signature agreement, so a lookup costs about the same however many texts
+    were added.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, bands: int = 16, shingle_size: int = 5,
+                 seed: int = 1):
+        """
+        Args:
+            threshold: Estimated Jaccard similarity from which two texts are near-duplicates.
+            num_perm: Length of the MinHash signatures. Must be a multiple of bands.
+            bands: Number of LSH bands; more bands find less similar candidates.
+            shingle_size: Length of the character n-grams compared.
+        """
+        assert num_perm % bands == 0, 'num_perm must be a multiple of bands'
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 2 ** 32, size=(num_perm, 1), dtype=np.uint64)
+        self._b = rng.randint(0, 2 ** 32, size=(num_perm, 1), dtype=np.uint64)
+        self._signatures = []
+        self._buckets = [{} for _ in range(bands)]
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def signature(self, text: str) -> np.ndarray:
+        return ((self._a * shingles(text, self.shingle_size)[None, :] + self._b) % _PRIME).min(axis=1)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def find(self, text: str, signature: Optional[np.ndarray] = None) -> Optional[int]:
+        """Id of the most similar added text if it is a near-duplicate of text, else None."""
+        signature = self.signature(text) if signature is None else signature
+        candidates = set()
+        for bucket, key in zip(self._buckets, self._band_keys(signature)):
+            candidates.update(bucket.get(key, ()))
+        best, best_similarity = None, self.threshold
+        for candidate in sorted(candidates):
+            similarity = float(np.mean(self._signatures[candidate] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        return best
+
+    def add(self, text: str, signature: Optional[np.ndarray] = None) -> int:
+        """Add text and return its id, the number of texts added before it."""
+        signature = self.signature(text) if signature is None else signature
+        text_id = len(self._signatures)
+        self._signatures.append(signature)
+        for bucket, key in zip(self._buckets, self._band_keys(signature)):
+            bucket.setdefault(key, []).append(text_id)
+        return text_id
+
+    def find_or_add(self, text: str) -> Optional[int]:
+        """Id of the near-duplicate of text if there is one; otherwise add text and return None."""
+        signature = self.signature(text)
+        match = self.find(text, signature)
+        if match is None:
+            self.add(text, signature)
+        return match
@@ -0,0 +1,59 @@
+import hashlib
+import os
+import time
+from typing import Dict, Optional
+
+from src.utils.DiskCache import DiskCache
+
+
+class PageCache:
+    """
+    Disk-backed cache of downloaded web pages and of the text extracted from them.
+
+    Pages are stored compressed together with their ETag / Last-Modified validators. A page younger than
+    `fresh_for` seconds is served without touching the network; an older one is revalidated with a
+    conditional request. Pages are evicted after `ttl` seconds. Extracted text is keyed by the hash of the
+    page body, so it is reused whenever the same content comes back, under any URL.
+    """
+
+    def __init__(self, cache_dir: str, fresh_for: float = 24 * 3600, ttl: float = 30 * 24 * 3600,
+                 max_entries: Optional[int] = 100000):
+        path = os.path.join(cache_dir, 'pages.sqlite')
+        self.fresh_for = fresh_for
+        self.pages = DiskCache(path, table='pages', ttl=ttl, max_entries=max_entries)
+        self.texts = DiskCache(path, table='texts', ttl=ttl, max_entries=max_entries)
+
+    @staticmethod
+    def body_hash(body: bytes) -> str:
+        return hashlib.sha1(body).hexdigest()
+
+    def get_page(self, url: str) -> Optional[Dict]:
+        """Returns a dict with 'body', 'etag', 'last_modified' and 'fetched_at', or None."""
+        return self.pages.get(url)
+
+    def is_fresh(self, entry: Dict) -> bool:
+        return time.time() - entry['fetched_at'] <= self.fresh_for
+
+    def put_page(self, url: str, body: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        self.pages.set(url, {
+            'body': body,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched_at': time.time(),
+        })
+
+    def conditional_headers(self, entry: Optional[Dict]) -> Dict[str, str]:
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def get_text(self, body: bytes, default=None):
+        """Return the cached extraction result of a page body (which may be None), or default on a miss."""
+        return self.texts.get(self.body_hash(body), default)
+
+    def put_text(self, body: bytes, text: Optional[str]):
+        self.texts.set(self.body_hash(body), text)
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+from typing import Optional
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count of text, used to reserve budget before the real usage is known: about one token per
+    CJK character and one per four other characters.
+    """
+    cjk = sum(1 for c in text if '\u4e00' <= c <= '\u9fff' or '\u3040' <= c <= '\u30ff' or '\uac00' <= c <= '\ud7af')
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budget of one model, as two token buckets refilled continuously.
+
+    A call reserves one request and its estimated tokens before it is sent (blocking or awaiting until the
+    buckets allow it) and settles the reservation with the real usage once the response arrives. It is
+    thread-safe and can be shared by threads and coroutines alike.
+    """
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        """
+        Args:
+            rpm: Maximum number of requests per minute. None for no limit.
+            tpm: Maximum number of (prompt + completion) tokens per minute. None for no limit.
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self._lock = threading.Lock()
+        self._requests = float(rpm or 0)
+        self._tokens = float(tpm or 0)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _try_reserve(self, tokens: int) -> float:
+        """Reserve the request if the buckets allow it and return 0, otherwise return the seconds to wait."""
+        with self._lock:
+            self._refill()
+            # A single request larger than the whole minute budget must still get through eventually.
+            tokens = min(tokens, self.tpm) if self.tpm else 0
+            wait = 0.0
+            if self.rpm and self._requests < 1:
+                wait = max(wait, (1 - self._requests) * 60 / self.rpm)
+            if self.tpm and self._tokens < tokens:
+                wait = max(wait, (tokens - self._tokens) * 60 / self.tpm)
+            if wait > 0:
+                return wait
+            if self.rpm:
+                self._requests -= 1
+            if self.tpm:
+                self._tokens -= tokens
+            return 0.0
+
+    def acquire(self, tokens: int = 0) -> int:
+        """Block until a request of `tokens` estimated tokens fits the budget. Returns the reserved tokens."""
+        while True:
+            wait = self._try_reserve(tokens)
+            if wait <= 0:
+                return tokens
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int = 0) -> int:
+        """Async variant of acquire."""
+        while True:
+            wait = self._try_reserve(tokens)
+            if wait <= 0:
+                return tokens
+            await asyncio.sleep(wait)
+
+    def settle(self, reserved: int, used: int):
+        """Correct a reservation once the real token usage is known, refunding or charging the difference."""
+        if not self.tpm:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.tpm, self._tokens + min(reserved, self.tpm) - used)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model: str, rpm: Optional[float] = None, tpm: Optional[float] = None) -> Optional[RateLimiter]:
+    """
+    The RateLimiter of a model, shared by every wrapper instance in the process. The first call that passes
+    limits creates it; later calls return that one. Returns None if no limit was ever set for the model.
+    """
+    with _rate_limiters_lock:
+        if model not in _rate_limiters and (rpm or tpm):
+            _rate_limiters[model] = RateLimiter(rpm=rpm, tpm=tpm)
+        return _rate_limiters.get(model)
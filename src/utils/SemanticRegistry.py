@@ -0,0 +1,115 @@
+import threading
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from src.utils.VectorIndex import normalize_rows
+
+
+class _EmbeddingStore:
+    def __init__(self):
+        self.texts = []
+        self.vectors = None
+
+    def best_match(self, vector: np.ndarray, threshold: float) -> Optional[int]:
+        """Index of the most similar stored text if its cosine similarity reaches threshold, else None."""
+        if self.vectors is None:
+            return None
+        scores = self.vectors @ vector
+        best = int(np.argmax(scores))
+        return best if scores[best] >= threshold else None
+
+    def add(self, text: str, vector: np.ndarray):
+        self.texts.append(text)
+        self.vectors = vector[None, :] if self.vectors is None else np.vstack([self.vectors, vector])
+
+
+class SemanticRegistry:
+    """
+    Map-wide registry of the categories and keywords already explored, used to skip near-duplicates that
+    different nodes come up with before any search or LM call is spent on them.
+
+    A category close to one already explored elsewhere in the map is dropped; one close to another category of
+    the same node is merged into it. A keyword close to one already searched is dropped, and a category left
+    without keywords is dropped too. Similarity is the cosine of the texts' embeddings.
+    """
+
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray], threshold: float = 0.9):
+        """
+        Args:
+            encode_fn: Embeds a list of texts.
+            threshold: Cosine similarity from which two categories or keywords count as duplicates.
+        """
+        self.encode_fn = encode_fn
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._categories = _EmbeddingStore()
+        self._keywords = _EmbeddingStore()
+        self.stats = dict.fromkeys(
+            ('categories_dropped', 'categories_merged', 'keywords_dropped', 'saved_searches', 'saved_llm_calls'), 0)
+
+    def register_categories(self, categories: List[str]):
+        """Record categories explored without going through filter_categories, e.g. those of a restored map."""
+        if not categories:
+            return
+        vectors = normalize_rows(self.encode_fn(categories))
+        with self._lock:
+            for category, vector in zip(categories, vectors):
+                self._categories.add(category, vector)
+
+    def filter_categories(self, categories: Dict[str, List[str]],
+                          max_categories: Optional[int] = None) -> Dict[str, List[str]]:
+        """
+        Drop or merge the duplicate categories and keywords of one node's {category: [keyword, ...]} and keep
+        at most max_categories of the rest. What is kept is registered as explored.
+        """
+        names = list(categories)
+        keywords = [keyword for name in names for keyword in categories[name]]
+        if not names:
+            return {}
+        vectors = normalize_rows(self.encode_fn(names + keywords))
+        category_vectors = dict(zip(names, vectors[:len(names)]))
+        keyword_vectors = dict(zip(keywords, vectors[len(names):]))
+
+        with self._lock:
+            kept = {}
+            for name in names:
+                match = self._categories.best_match(category_vectors[name], self.threshold)
+                if match is not None and self._categories.texts[match] in kept:
+                    # A near-duplicate of another category of this node: search its keywords under that one.
+                    merged_into = self._categories.texts[match]
+                    kept[merged_into].extend(self._filter_keywords(categories[name], keyword_vectors))
+                    self.stats['categories_merged'] += 1
+                    self.stats['saved_llm_calls'] += 1
+                elif match is not None:
+                    self.stats['categories_dropped'] += 1
+                    self.stats['saved_searches'] += len(categories[name])
+                    self.stats['saved_llm_calls'] += 1
+                elif max_categories is None or len(kept) < max_categories:
+                    new_keywords = self._filter_keywords(categories[name], keyword_vectors)
+                    if not new_keywords:
+                        self.stats['categories_dropped'] += 1
+                        self.stats['saved_llm_calls'] += 1
+                        continue
+                    kept[name] = new_keywords
+                    self._categories.add(name, category_vectors[name])
+            return kept
+
+    def _filter_keywords(self, keywords: List[str], keyword_vectors: Dict[str, np.ndarray]) -> List[str]:
+        """Keep and register the keywords not close to one already searched. Called with the lock held."""
+        new_keywords = []
+        for keyword in dict.fromkeys(keywords):
+            if self._keywords.best_match(keyword_vectors[keyword], self.threshold) is not None:
+                self.stats['keywords_dropped'] += 1
+                self.stats['saved_searches'] += 1
+                continue
+            self._keywords.add(keyword, keyword_vectors[keyword])
+            new_keywords.append(keyword)
+        return new_keywords
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats)
@@ -0,0 +1,187 @@
+import contextlib
+import contextvars
+import json
+import threading
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+# List prices in USD per 1000 (prompt, completion) tokens, by model name prefix; the longest matching prefix
+# wins. Qwen prices are those of the international DashScope (Model Studio) endpoint.
+DEFAULT_PRICES = {
+    'qwen-max': (0.0016, 0.0064),
+    'qwen-plus': (0.0004, 0.0012),
+    'qwen-turbo': (0.00005, 0.0002),
+    'gpt-4o': (0.0025, 0.01),
+    'gpt-4o-mini': (0.00015, 0.0006),
+    'gpt-4-turbo': (0.01, 0.03),
+    'gpt-4': (0.03, 0.06),
+    'gpt-3.5-turbo': (0.0005, 0.0015),
+}
+
+_current_stage = contextvars.ContextVar('usage_stage', default='other')
+_current_meters = contextvars.ContextVar('usage_meters', default=())
+
+
+@contextlib.contextmanager
+def usage_stage(stage: str):
+    """Attribute the LM calls made inside the block (in the current thread) to `stage`."""
+    token = _current_stage.set(stage)
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+
+
+def current_stage() -> str:
+    return _current_stage.get()
+
+
+class UsageMeter:
+    """Running token total of the LM calls made inside usage_meter(meter) blocks, e.g. to cap one map build."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def add(self, prompt_tokens: int, completion_tokens: int):
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+@contextlib.contextmanager
+def usage_meter(meter: UsageMeter):
+    """Also count the LM calls made inside the block (in the current thread) on meter."""
+    token = _current_meters.set(_current_meters.get() + (meter,))
+    try:
+        yield meter
+    finally:
+        _current_meters.reset(token)
+
+
+class UsageTracker:
+    """
+    Thread-safe accounting of LM calls, aggregated per (stage, model).
+
+    For every call it records prompt / completion tokens, latency, retries and whether the answer came from
+    the completion cache. Cost is derived from per-model prices: those set with set_price or load_prices,
+    else DEFAULT_PRICES. Models with neither cost 0.
+    """
+
+    FIELDS = ('calls', 'cached_calls', 'prompt_tokens', 'completion_tokens', 'retries', 'latency')
+    PACKING_FIELDS = ('calls', 'context_tokens', 'packed_tokens')
+
+    def __init__(self, prices: Optional[Dict[str, Tuple[float, float]]] = None):
+        """
+        Args:
+            prices: Maps a model name to its (prompt, completion) price per 1000 tokens.
+        """
+        self.prices = dict(prices or {})
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: dict.fromkeys(self.FIELDS, 0))
+        self._packing = defaultdict(lambda: dict.fromkeys(self.PACKING_FIELDS, 0))
+
+    def set_price(self, model: str, prompt_price_per_1k: float, completion_price_per_1k: float):
+        self.prices[model] = (prompt_price_per_1k, completion_price_per_1k)
+
+    def load_prices(self, filename: str):
+        """Set the prices of a JSON file mapping model names to [prompt, completion] prices per 1000 tokens."""
+        with open(filename, 'r', encoding='utf-8') as f:
+            for model, (prompt_price, completion_price) in json.load(f).items():
+                self.set_price(model, prompt_price, completion_price)
+
+    def get_price(self, model: str) -> Tuple[float, float]:
+        """The (prompt, completion) price per 1000 tokens of model."""
+        if model in self.prices:
+            return self.prices[model]
+        matches = [prefix for prefix in DEFAULT_PRICES if model.lower().startswith(prefix)]
+        return DEFAULT_PRICES[max(matches, key=len)] if matches else (0.0, 0.0)
+
+    def record(self, model: str, prompt_tokens: int = 0, completion_tokens: int = 0, latency: float = 0.0,
+               retries: int = 0, cached: bool = False, stage: Optional[str] = None):
+        stage = stage or current_stage()
+        for meter in _current_meters.get():
+            meter.add(prompt_tokens, completion_tokens)
+        with self._lock:
+            stats = self._stats[(stage, model)]
+            stats['calls'] += 1
+            stats['cached_calls'] += int(cached)
+            stats['prompt_tokens'] += prompt_tokens
+            stats['completion_tokens'] += completion_tokens
+            stats['retries'] += retries
+            stats['latency'] += latency
+
+    def record_packing(self, context_tokens: int, packed_tokens: int, stage: Optional[str] = None):
+        """Record that a prompt's context of context_tokens tokens was packed into packed_tokens."""
+        stage = stage or current_stage()
+        with self._lock:
+            stats = self._packing[stage]
+            stats['calls'] += 1
+            stats['context_tokens'] += context_tokens
+            stats['packed_tokens'] += packed_tokens
+
+    def packing_summary(self) -> Dict[str, Dict]:
+        """Returns {stage: stats}, where stats also contains the tokens saved by packing."""
+        with self._lock:
+            snapshot = {stage: dict(stats) for stage, stats in self._packing.items()}
+        for stats in snapshot.values():
+            stats['saved_tokens'] = stats['context_tokens'] - stats['packed_tokens']
+        return snapshot
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        prompt_price, completion_price = self.get_price(model)
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+    def summary(self) -> Dict[str, Dict[str, Dict]]:
+        """Returns {stage: {model: stats}}, where stats also contains the cost of the calls."""
+        with self._lock:
+            snapshot = {key: dict(stats) for key, stats in self._stats.items()}
+        return self._summarize(snapshot)
+
+    def _summarize(self, snapshot) -> Dict[str, Dict[str, Dict]]:
+        summary = defaultdict(dict)
+        for (stage, model), stats in snapshot.items():
+            stats['cost'] = self.cost(model, stats['prompt_tokens'], stats['completion_tokens'])
+            summary[stage][model] = stats
+        return dict(summary)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._packing.clear()
+
+    def get_usage_and_reset(self) -> Dict[str, Dict[str, Dict]]:
+        with self._lock:
+            snapshot = {key: dict(stats) for key, stats in self._stats.items()}
+            self._stats.clear()
+        return self._summarize(snapshot)
+
+    def report(self) -> str:
+        """A plain-text table of the usage per stage and model."""
+        header = f"{'stage':<10} {'model':<24} {'calls':>6} {'cached':>6} {'prompt':>9} {'completion':>10} " \
+                 f"{'retries':>7} {'latency(s)':>10} {'cost':>9}"
+        lines = [header, '-' * len(header)]
+        for stage, models in sorted(self.summary().items()):
+            for model, s in sorted(models.items()):
+                lines.append(f"{stage:<10} {model:<24} {s['calls']:>6} {s['cached_calls']:>6} "
+                             f"{s['prompt_tokens']:>9} {s['completion_tokens']:>10} {s['retries']:>7} "
+                             f"{s['latency']:>10.1f} {s['cost']:>9.4f}")
+        packing = self.packing_summary()
+        if packing:
+            header = f"{'stage':<10} {'packed':>6} {'context':>9} {'kept':>9} {'saved':>9}"
+            lines += ['', header, '-' * len(header)]
+            for stage, s in sorted(packing.items()):
+                lines.append(f"{stage:<10} {s['calls']:>6} {s['context_tokens']:>9} {s['packed_tokens']:>9} "
+                             f"{s['saved_tokens']:>9}")
+        return '\n'.join(lines)
+
+
+# Shared by all LM wrappers unless they are given their own tracker.
+usage_tracker = UsageTracker()
@@ -0,0 +1,198 @@
+import json
+from typing import Dict, Tuple
+
+import numpy as np
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize each row so that a dot product equals cosine similarity."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Return the indices of the k highest scores of every row, sorted by descending score.
+
+    Uses np.argpartition so that selecting k out of N costs O(N) instead of the O(N log N) full sort.
+    """
+    scores = np.atleast_2d(scores)
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+class BruteForceIndex:
+    """Exact cosine-similarity index over a dense embedding matrix."""
+
+    index_type = 'brute_force'
+
+    def __init__(self):
+        self.embeddings = np.zeros((0, 0), dtype=np.float32)
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    def build(self, embeddings: np.ndarray):
+        self.embeddings = normalize_rows(embeddings) if len(embeddings) else np.zeros((0, 0), dtype=np.float32)
+        return self
+
+    def search(self, queries: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Search the top_k most similar rows for every query.
+
+        Returns:
+            (scores, indices), both of shape (num_queries, k) and sorted by descending similarity.
+        """
+        queries = normalize_rows(queries)
+        if len(self) == 0:
+            empty = np.zeros((queries.shape[0], 0))
+            return empty, empty.astype(np.int64)
+        sim = queries @ self.embeddings.T
+        indices = top_k_indices(sim, top_k)
+        return np.take_along_axis(sim, indices, axis=1), indices
+
+    def state_dict(self) -> Dict[str, np.ndarray]:
+        return {'embeddings': self.embeddings}
+
+    def load_state_dict(self, state: Dict[str, np.ndarray]):
+        self.embeddings = np.asarray(state['embeddings'], dtype=np.float32)
+        return self
+
+
+class IVFIndex(BruteForceIndex):
+    """
+    Approximate inverted-file index: snippets are clustered with k-means and a query is only scored
+    against the members of its n_probe closest clusters.
+
+    Args:
+        n_lists: Number of clusters. Defaults to roughly sqrt(N).
+        n_probe: Number of clusters visited per query.
+        min_size: Below this many vectors the index falls back to exact search.
+    """
+
+    index_type = 'ivf'
+
+    def __init__(self, n_lists: int = 0, n_probe: int = 8, min_size: int = 1024,
+                 n_iter: int = 10, seed: int = 0):
+        super().__init__()
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_size = min_size
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.assignments = np.zeros(0, dtype=np.int64)
+        self.lists = []
+
+    def build(self, embeddings: np.ndarray):
+        super().build(embeddings)
+        if len(self) < self.min_size:
+            self.centroids = np.zeros((0, 0), dtype=np.float32)
+            self.assignments = np.zeros(0, dtype=np.int64)
+            self.lists = []
+            return self
+
+        n_lists = self.n_lists or int(np.sqrt(len(self)))
+        n_lists = max(1, min(n_lists, len(self)))
+        rng = np.random.default_rng(self.seed)
+        centroids = self.embeddings[rng.choice(len(self), n_lists, replace=False)]
+        for _ in range(self.n_iter):
+            assignments = np.argmax(self.embeddings @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = self.embeddings[assignments == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids = normalize_rows(centroids)
+        self.centroids = centroids
+        self.assignments = np.argmax(self.embeddings @ centroids.T, axis=1)
+        self._build_lists()
+        return self
+
+    def _build_lists(self):
+        self.lists = [np.flatnonzero(self.assignments == c) for c in range(len(self.centroids))]
+
+    def search(self, queries: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if len(self.centroids) == 0:
+            return super().search(queries, top_k)
+
+        queries = normalize_rows(queries)
+        probes = top_k_indices(queries @ self.centroids.T, self.n_probe)
+        all_scores, all_indices = [], []
+        for query, probe in zip(queries, probes):
+            candidates = np.concatenate([self.lists[c] for c in probe])
+            sim = self.embeddings[candidates] @ query
+            order = top_k_indices(sim, top_k)[0]
+            all_scores.append(sim[order])
+            all_indices.append(candidates[order])
+
+        # Rows may hold fewer than top_k hits when the probed clusters are small; pad with -1.
+        k = max(len(i) for i in all_indices)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, (s, i) in enumerate(zip(all_scores, all_indices)):
+            scores[row, :len(s)] = s
+            indices[row, :len(i)] = i
+        return scores, indices
+
+    def state_dict(self) -> Dict[str, np.ndarray]:
+        return {
+            'embeddings': self.embeddings,
+            'centroids': self.centroids,
+            'assignments': self.assignments,
+            'params': np.array([self.n_lists, self.n_probe, self.min_size, self.n_iter, self.seed]),
+        }
+
+    def load_state_dict(self, state: Dict[str, np.ndarray]):
+        super().load_state_dict(state)
+        self.centroids = np.asarray(state['centroids'], dtype=np.float32)
+        self.assignments = np.asarray(state['assignments'], dtype=np.int64)
+        self.n_lists, self.n_probe, self.min_size, self.n_iter, self.seed = [int(p) for p in state['params']]
+        self._build_lists()
+        return self
+
+
+INDEX_TYPES = {
+    BruteForceIndex.index_type: BruteForceIndex,
+    IVFIndex.index_type: IVFIndex,
+}
+
+
+def create_index(index_type: str = 'brute_force', **kwargs):
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {list(INDEX_TYPES)}")
+    return INDEX_TYPES[index_type](**kwargs)
+
+
+def save_index(index, filename: str, **extra_arrays):
+    """Save an index (plus any extra arrays, e.g. the snippet table) into a single .npz file."""
+    meta = json.dumps({'index_type': index.index_type}).encode('utf-8')
+    arrays = {f'index_{k}': v for k, v in index.state_dict().items()}
+    with open(filename, 'wb') as f:
+        np.savez(f, meta=np.frombuffer(meta, dtype=np.uint8), **arrays, **extra_arrays)
+
+
+def load_index(filename: str):
+    """
+    Load an index saved by save_index.
+
+    Returns:
+        (index, extra_arrays)
+    """
+    with np.load(filename, allow_pickle=False) as data:
+        meta = json.loads(data['meta'].tobytes().decode('utf-8'))
+        state = {k[len('index_'):]: data[k] for k in data.files if k.startswith('index_')}
+        extra = {k: data[k] for k in data.files if k != 'meta' and not k.startswith('index_')}
+    index = create_index(meta['index_type']).load_state_dict(state)
+    return index, extra
@@ -1,79 +1,314 @@
+import asyncio
 import concurrent.futures
-from typing import List, Dict
+import itertools
+import multiprocessing
+import threading
+from collections import defaultdict
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncIterator, List, Dict, Optional, Tuple
+from urllib.parse import urlsplit
 
 import httpx
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from trafilatura import extract
 
+from src.utils.PageCache import PageCache
+
+_MISS = object()
+_TEXT_SPLITTERS = {}
+
+
+def create_text_splitter(snippet_chunk_size: int) -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(
+        chunk_size=snippet_chunk_size,
+        chunk_overlap=0,
+        length_function=len,
+        is_separator_regex=False,
+        separators=[
+            "\n\n",
+            "\n",
+            ".",
+            "\uff0e",  # Fullwidth full stop
+            "\u3002",  # Ideographic full stop
+            ",",
+            "\uff0c",  # Fullwidth comma
+            "\u3001",  # Ideographic comma
+            " ",
+            "\u200B",  # Zero-width space
+            "",
+        ],
+    )
+
+
+def extract_text(html: bytes) -> Optional[str]:
+    return extract(
+        html,
+        include_tables=False,
+        include_comments=False,
+        output_format="txt",
+    )
+
+
+def extract_article(html: bytes, min_char_count: int, snippet_chunk_size: Optional[int] = None,
+                    article_text: Optional[str] = None) -> Tuple[Optional[str], Optional[Dict]]:
+    """
+    Extract the main text of a page and split it into snippets.
+
+    This is a module-level function so that it can run in a worker process. The raw body is passed as bytes
+    and decoded by trafilatura itself.
+
+    Args:
+        html: Raw page body.
+        snippet_chunk_size: Maximum character count for each snippet. If None, the text is not split.
+        article_text: Previously extracted text of this body, if known, to skip extraction.
+
+    Returns:
+        (article_text, article), where article is None if the text is missing or too short.
+    """
+    if article_text is None:
+        article_text = extract_text(html)
+    if article_text is None or len(article_text) <= min_char_count:
+        return article_text, None
+    if snippet_chunk_size is None:
+        return article_text, {"text": article_text}
+    if snippet_chunk_size not in _TEXT_SPLITTERS:
+        _TEXT_SPLITTERS[snippet_chunk_size] = create_text_splitter(snippet_chunk_size)
+    return article_text, {"text": article_text, "snippets": _TEXT_SPLITTERS[snippet_chunk_size].split_text(article_text)}
+
+
 class WebPageHelper:
     """Helper class to process web pages.
 
     Acknowledgement: Part of the code is adapted from https://github.com/stanford-oval/WikiChat project.
     """
 
-    def __init__(self, min_char_count: int = 150, snippet_chunk_size: int = 1000, max_thread_num: int = 10):
+    def __init__(self, min_char_count: int = 150, snippet_chunk_size: int = 1000, max_thread_num: int = 10,
+                 cache_dir: Optional[str] = None, page_cache: Optional[PageCache] = None,
+                 per_host_limit: int = 2, extract_workers: Optional[int] = None,
+                 extract_backend: str = 'inline', extract_chunksize: int = 4):
         """
         Args:
             min_char_count: Minimum character count for the article to be considered valid.
             snippet_chunk_size: Maximum character count for each snippet.
             max_thread_num: Maximum number of threads to use for concurrent requests (e.g., downloading webpages).
+            cache_dir: If set, downloaded pages and extracted texts are cached on disk there.
+            page_cache: An existing PageCache to use instead of creating one from cache_dir.
+            per_host_limit: Maximum number of concurrent requests to one host in the async pipeline.
+            extract_workers: Number of extraction processes. Defaults to the number of CPUs.
+            extract_backend: Where urls_to_articles / urls_to_snippets extract and split pages: 'inline' in the
+                calling thread, or 'process' in the process pool. The async pipeline always uses the pool.
+            extract_chunksize: Number of pages sent to a worker process per task with the 'process' backend.
         """
+        if extract_backend not in ('inline', 'process'):
+            raise ValueError(f"extract_backend must be 'inline' or 'process', got {extract_backend!r}")
         self.httpx_client = httpx.Client(verify=False)
+        self.page_cache = page_cache if page_cache is not None else (PageCache(cache_dir) if cache_dir else None)
         self.min_char_count = min_char_count
+        self.snippet_chunk_size = snippet_chunk_size
         self.max_thread_num = max_thread_num
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=snippet_chunk_size,
-            chunk_overlap=0,
-            length_function=len,
-            is_separator_regex=False,
-            separators=[
-                "\n\n",
-                "\n",
-                ".",
-                "\uff0e",  # Fullwidth full stop
-                "\u3002",  # Ideographic full stop
-                ",",
-                "\uff0c",  # Fullwidth comma
-                "\u3001",  # Ideographic comma
-                " ",
-                "\u200B",  # Zero-width space
-                "",
-            ],
-        )
+        self.per_host_limit = per_host_limit
+        self.extract_workers = extract_workers
+        self.extract_backend = extract_backend
+        self.extract_chunksize = extract_chunksize
+        self._process_pool = None
+        self._process_pool_lock = threading.Lock()
+        self.text_splitter = create_text_splitter(snippet_chunk_size)
+
+    def _cached_page(self, url: str) -> Tuple[Optional[bytes], Optional[Dict]]:
+        """Returns (body if the cached copy is fresh, cached entry)."""
+        cached = self.page_cache.get_page(url) if self.page_cache is not None else None
+        if cached is not None and self.page_cache.is_fresh(cached):
+            return cached['body'], cached
+        return None, cached
+
+    def _handle_response(self, url: str, res: httpx.Response, cached: Optional[Dict]) -> bytes:
+        if res.status_code == 304 and cached is not None:
+            self.page_cache.put_page(url, cached['body'], cached['etag'], cached['last_modified'])
+            return cached['body']
+        if res.status_code >= 400:
+            res.raise_for_status()
+        if self.page_cache is not None:
+            self.page_cache.put_page(url, res.content, res.headers.get('ETag'), res.headers.get('Last-Modified'))
+        return res.content
 
     def download_webpage(self, url: str):
+        body, cached = self._cached_page(url)
+        if body is not None:
+            return body
         try:
-            res = self.httpx_client.get(url, timeout=4)
-            if res.status_code >= 400:
-                res.raise_for_status()
-            return res.content
+            headers = self.page_cache.conditional_headers(cached) if cached is not None else None
+            res = self.httpx_client.get(url, timeout=4, headers=headers)
+            return self._handle_response(url, res, cached)
         except httpx.HTTPError as exc:
             print(f"Error while requesting {exc.request.url!r} - {exc!r}")
-            return None
+            # Serve the stale copy rather than nothing if revalidation failed.
+            return cached['body'] if cached is not None else None
+
+    def extract_text(self, html: bytes) -> Optional[str]:
+        article_text = self.page_cache.get_text(html, _MISS) if self.page_cache is not None else _MISS
+        if article_text is _MISS:
+            article_text = extract_text(html)
+            if self.page_cache is not None:
+                self.page_cache.put_text(html, article_text)
+        return article_text
 
     def urls_to_articles(self, urls: List[str]) -> Dict:
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_thread_num) as executor:
             htmls = list(executor.map(self.download_webpage, urls))
 
+        if self.extract_backend == 'process':
+            return self._extract_in_processes(urls, htmls, snippet_chunk_size=None)
+
         articles = {}
 
         for h, u in zip(htmls, urls):
             if h is None:
                 continue
-            article_text = extract(
-                h,
-                include_tables=False,
-                include_comments=False,
-                output_format="txt",
-            )
+            article_text = self.extract_text(h)
             if article_text is not None and len(article_text) > self.min_char_count:
                 articles[u] = {"text": article_text}
 
         return articles
 
     def urls_to_snippets(self, urls: List[str]) -> Dict:
+        if self.extract_backend == 'process':
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_thread_num) as executor:
+                htmls = list(executor.map(self.download_webpage, urls))
+            return self._extract_in_processes(urls, htmls, snippet_chunk_size=self.snippet_chunk_size)
+
         articles = self.urls_to_articles(urls)
         for u in articles:
             articles[u]["snippets"] = self.text_splitter.split_text(articles[u]["text"])
 
         return articles
+
+    def _extract_in_processes(self, urls: List[str], htmls: List[Optional[bytes]],
+                              snippet_chunk_size: Optional[int]) -> Dict:
+        """Extract (and optionally split) the downloaded pages in the process pool, in chunks of pages."""
+        jobs = []
+        for u, h in zip(urls, htmls):
+            if h is None:
+                continue
+            cached_text = self.page_cache.get_text(h, _MISS) if self.page_cache is not None else _MISS
+            if cached_text is None:
+                continue  # extraction already failed on this body before
+            jobs.append((u, h, cached_text))
+
+        pool = self.get_process_pool()
+        try:
+            results = list(pool.map(
+                extract_article,
+                [h for _, h, _ in jobs],
+                itertools.repeat(self.min_char_count),
+                itertools.repeat(snippet_chunk_size),
+                [None if t is _MISS else t for _, _, t in jobs],
+                chunksize=self.extract_chunksize,
+            ))
+        except BrokenProcessPool:
+            self.discard_process_pool(pool)
+            raise
+
+        articles = {}
+        for (u, h, cached_text), (article_text, article) in zip(jobs, results):
+            if cached_text is _MISS and self.page_cache is not None:
+                self.page_cache.put_text(h, article_text)
+            if article is not None:
+                articles[u] = article
+
+        return articles
+
+    def get_process_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._process_pool_lock:
+            if self._process_pool is None:
+                # Not forked: a fork would copy locks held by the encoder, HTTP and SQLite threads of this
+                # process into the workers, which could then deadlock on them.
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.extract_workers, mp_context=multiprocessing.get_context(method))
+        return self._process_pool
+
+    def discard_process_pool(self, pool: concurrent.futures.ProcessPoolExecutor):
+        """Drop pool once it is broken (e.g. a worker died), so that the next extraction starts a new one."""
+        with self._process_pool_lock:
+            if self._process_pool is pool:
+                self._process_pool = None
+        pool.shutdown(wait=False)
+
+    async def _aextract(self, html: bytes, cached_text) -> Tuple[Optional[str], Optional[Dict]]:
+        """Run extract_article in the process pool, retrying once on a new pool if the pool broke meanwhile."""
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            pool = self.get_process_pool()
+            try:
+                return await loop.run_in_executor(pool, extract_article, html, self.min_char_count,
+                                                  self.snippet_chunk_size,
+                                                  None if cached_text is _MISS else cached_text)
+            except BrokenProcessPool:
+                self.discard_process_pool(pool)
+                if attempt:
+                    raise
+
+    async def _in_thread_if_cached(self, fn, *args):
+        """Run fn in a worker thread when it may read or write the SQLite page cache, not on the event loop."""
+        if self.page_cache is None:
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    async def adownload_webpage(self, client: httpx.AsyncClient, url: str):
+        body, cached = await self._in_thread_if_cached(self._cached_page, url)
+        if body is not None:
+            return body
+        try:
+            headers = self.page_cache.conditional_headers(cached) if cached is not None else None
+            res = await client.get(url, timeout=4, headers=headers)
+            return await self._in_thread_if_cached(self._handle_response, url, res, cached)
+        except httpx.HTTPError as exc:
+            print(f"Error while requesting {url!r} - {exc!r}")
+            return cached['body'] if cached is not None else None
+
+    async def astream_snippets(self, urls: List[str]) -> AsyncIterator[Tuple[str, Dict]]:
+        """
+        Download, extract and split pages concurrently, yielding (url, {'text', 'snippets'}) as soon as each
+        page is ready, so a slow host only delays its own pages.
+
+        Downloads run on an httpx.AsyncClient limited to max_thread_num requests in total and per_host_limit
+        per host; extraction and splitting run in a process pool.
+        """
+        total_limit = asyncio.Semaphore(self.max_thread_num)
+        host_limits = defaultdict(lambda: asyncio.Semaphore(self.per_host_limit))
+
+        async def process(client: httpx.AsyncClient, url: str):
+            async with host_limits[urlsplit(url).netloc], total_limit:
+                html = await self.adownload_webpage(client, url)
+            if html is None:
+                return url, None
+            cached_text = await asyncio.to_thread(self.page_cache.get_text, html, _MISS) \
+                if self.page_cache is not None else _MISS
+            if cached_text is None:
+                return url, None  # extraction already failed on this body before
+            try:
+                article_text, article = await self._aextract(html, cached_text)
+            except Exception as exc:
+                print(f"Error while extracting {url!r} - {exc!r}")
+                return url, None
+            if cached_text is _MISS and self.page_cache is not None:
+                await asyncio.to_thread(self.page_cache.put_text, html, article_text)
+            return url, article
+
+        async with httpx.AsyncClient(verify=False) as client:
+            tasks = [asyncio.create_task(process(client, url)) for url in dict.fromkeys(urls)]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    url, article = await next_done
+                    if article is not None:
+                        yield url, article
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    async def aurls_to_snippets(self, urls: List[str]) -> Dict:
+        articles = {}
+        async for url, article in self.astream_snippets(urls):
+            articles[url] = article
+        # Keep the input order, like urls_to_snippets.
+        return {u: articles[u] for u in dict.fromkeys(urls) if u in articles}